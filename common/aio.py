@@ -0,0 +1,143 @@
+# asyncio drivers of the sliding window engines, an alternative to their select loops
+#
+# The engines are driven as in the select loops, through handle(msg, addr, now), on_timeout(now)
+# and next_deadline(), but every server session gets its own loop.call_later timer, re-armed only
+# when its deadline moves, so no loop iteration scans the sessions.  uvloop is used when installed.
+import asyncio
+from time import time
+
+
+# Method to create an event loop, uvloop's when it is installed
+def new_event_loop():
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+    return uvloop.new_event_loop()
+
+# Class that gives a datagram transport the sendto of the socket the engines expect
+class TransportSocket:
+    def __init__(self, transport):
+        self.transport = transport
+
+    def sendto(self, msg, addr):
+        self.transport.sendto(msg, addr)
+
+    def close(self):
+        self.transport.close()
+
+
+# Class that keeps one call_later timer per key at the deadline next_deadline(key) reports
+class Timers:
+    def __init__(self, loop, next_deadline, expire):
+        self.loop, self.next_deadline, self.expire = loop, next_deadline, expire
+        self.handles = {}       # key -> (deadline, TimerHandle)
+        self.closed = False
+
+    # Method to move the timer of key to its current deadline, or cancel it when there is none
+    def rearm(self, key):
+        if self.closed:
+            return
+        deadline = self.next_deadline(key)
+        old = self.handles.get(key)
+        if old is not None:
+            if old[0] == deadline:
+                return
+            old[1].cancel()
+            del self.handles[key]
+        if deadline is not None:
+            self.handles[key] = (deadline, self.loop.call_later(max(0, deadline - time()), self.fire, key))
+
+    def fire(self, key):
+        del self.handles[key]
+        self.expire(key, time())
+        self.rearm(key)
+
+    def cancel(self):
+        self.closed = True
+        for _, handle in self.handles.values():
+            handle.cancel()
+        self.handles.clear()
+
+
+# Class that feeds datagrams to a Server and runs the retransmission timer of each of its sessions
+class ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.timers = None
+
+    def connection_made(self, transport):
+        self.server.sock = TransportSocket(transport)
+        self.timers = Timers(asyncio.get_running_loop(), self.deadline_of, self.server.expire)
+
+    def deadline_of(self, addr):
+        session = self.server.sessions.get(addr)
+        return session.next_deadline() if session is not None else None
+
+    def datagram_received(self, msg, addr):
+        self.server.handle(msg, addr, time())
+        self.timers.rearm(addr)
+
+    def connection_lost(self, exc):
+        self.timers.cancel()
+
+
+# Class that feeds datagrams to a Download, resolving done once the transfer is over
+class DownloadProtocol(asyncio.DatagramProtocol):
+    def __init__(self, download, done):
+        self.download, self.done = download, done
+        self.timers = None
+
+    def connection_made(self, transport):
+        self.download.sock = TransportSocket(transport)
+        self.timers = Timers(asyncio.get_running_loop(), lambda key: self.download.next_deadline(), self.expire)
+        self.download.request(time())
+        self.timers.rearm(None)
+
+    def datagram_received(self, msg, addr):
+        if self.done.done():
+            return
+        if self.download.handle(msg, addr, time()):
+            self.finish()
+        else:
+            self.timers.rearm(None)
+
+    def expire(self, key, now):
+        if not self.done.done() and self.download.on_timeout(now):
+            self.finish()
+
+    def finish(self):
+        self.timers.cancel()
+        self.done.set_result(None)
+
+    def connection_lost(self, exc):
+        self.timers.cancel()
+
+
+# Method to serve on a bound socket until interrupted
+def serve(server, sock):
+    async def main():
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: ServerProtocol(server), sock=sock)
+        await loop.create_future()
+    loop = new_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+# Method to run a download on its socket until it is over, which closes the socket
+def run_download(d):
+    async def main():
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(lambda: DownloadProtocol(d, done), sock=d.sock)
+        try:
+            await done
+        finally:
+            transport.close()
+    loop = new_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
@@ -0,0 +1,125 @@
+# Batch get: many files sent back to back in one transfer, each preceded by a frame
+#
+# A REQUEST with the option b=1 carries a manifest, newline separated names (or glob
+# patterns with g=1) instead of one file name.  The server answers with one stream holding,
+# for every file, a FRAME, the name and then exactly size bytes of the file.
+import os
+from glob import glob
+from os.path import commonpath, isabs, isfile, join, normpath, realpath
+from struct import Struct
+
+from common.protocol import BLOCK_SIZE, encode_request
+
+FRAME = Struct('=BHQ')      # status, name length, file size
+FOUND = 0
+MISSING = 1                 # no file of that name below the server directory, or none matching the pattern; nothing follows the name
+CHUNK = 4096                # file bytes read per step
+
+
+def encode_manifest(names):
+    return '\n'.join(names)
+
+def decode_manifest(text):
+    return [name for name in text.split('\n') if name]
+
+# Method to split names into manifests that each fit into one REQUEST with the given options
+# [raises ValueError for a name that does not fit into one on its own]
+def pack_manifests(names, options):
+    manifests = [[]]
+    for name in names:
+        if len(encode_request(name, **options)) > BLOCK_SIZE:
+            raise ValueError('file name too long for a REQUEST: %r' % name)
+        if manifests[-1] and len(encode_request(encode_manifest(manifests[-1] + [name]), **options)) > BLOCK_SIZE:
+            manifests.append([])
+        manifests[-1].append(name)
+    return manifests
+
+# Method to tell whether a name stays below the server directory, neither absolute, nor climbing out with
+# '..', nor resolving out of it through a symbolic link
+def is_confined(root, name):
+    if isabs(name) or normpath(name).split(os.sep)[0] == '..':
+        return False
+    return commonpath([realpath(root), realpath(join(root, name))]) == realpath(root)
+
+# Method to list the files of the server directory a manifest names, expanding glob patterns when asked to
+def expand_manifest(root, names, patterns=False):
+    for name in names:
+        matches = sorted(m for m in glob(name, root_dir=root) if is_confined(root, m) and isfile(join(root, m))) if patterns else []
+        yield from matches or [name]    # an unmatched pattern is reported as missing under its own name
+
+# Method to generate the framed stream of the files of a manifest, read as it is consumed
+def batch_chunks(root, names, patterns=False):
+    for name in expand_manifest(root, names, patterns):
+        encoded = name.encode()
+        try:
+            if not is_confined(root, name):     # served as if it did not exist
+                raise FileNotFoundError(name)
+            f = open(join(root, name), 'rb')
+        except OSError:
+            yield FRAME.pack(MISSING, len(encoded), 0) + encoded
+            continue
+        with f:
+            remaining = os.fstat(f.fileno()).st_size
+            yield FRAME.pack(FOUND, len(encoded), remaining) + encoded
+            while remaining:
+                chunk = f.read(min(CHUNK, remaining)) or bytes(remaining)    # a file that shrank is padded to its framed size
+                remaining -= len(chunk)
+                yield chunk
+
+
+# Class that parses a framed batch stream as it is written and stores every file it carries under a directory
+class BatchWriter:
+    def __init__(self, directory):
+        self.directory = directory
+        self.pending = bytearray()  # bytes of a frame and name not complete yet
+        self.f = None               # file being written and the bytes it still lacks
+        self.remaining = 0
+        self.files = []             # (name, size), size None for a file the server did not find
+
+    # Method to resolve a name sent by the server below the directory, refusing any that would escape it
+    def path_of(self, name):
+        if isabs(name) or normpath(name).split(os.sep)[0] == '..':
+            raise ValueError('unsafe file name in batch: %r' % name)
+        return join(self.directory, normpath(name))
+
+    def write(self, data):
+        data = memoryview(data)
+        while data:
+            if self.f is not None:
+                n = min(len(data), self.remaining)
+                self.f.write(data[:n])
+                data = data[n:]
+                self.remaining -= n
+                if not self.remaining:
+                    self.f.close()
+                    self.f = None
+                continue
+            self.pending += data
+            data = memoryview(b'')
+            if len(self.pending) < FRAME.size:
+                return
+            status, length, size = FRAME.unpack_from(self.pending)
+            if len(self.pending) < FRAME.size + length:
+                return
+            name = self.pending[FRAME.size:FRAME.size + length].decode()
+            data = memoryview(bytes(self.pending[FRAME.size + length:]))
+            self.pending.clear()
+            if status == MISSING:
+                self.files.append((name, None))
+                continue
+            path = self.path_of(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.f = open(path, 'wb')
+            self.remaining = size
+            self.files.append((name, size))
+            if not size:
+                self.f.close()
+                self.f = None
+
+    # Method to close the file being written, removing it when the stream ended before it was complete
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            os.remove(self.f.name)
+            self.files.pop()
+            self.f = None
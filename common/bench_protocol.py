@@ -0,0 +1,92 @@
+# Micro-benchmark comparing the per-packet codec the programs used before
+# common/protocol.py with the precompiled Struct codec
+#
+#   python bench_protocol.py [--count 200000]
+import argparse
+from enum import Enum
+from os.path import abspath, dirname, join
+from struct import pack, unpack
+from sys import path
+from timeit import timeit
+
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+from common.protocol import BLOCK_SIZE, HEADER, LASTBLOCK_MASK, MSGTYPE_MASK, MSGTYPES, MsgType, encode_msg, decode_msg
+
+# Enum class the programs used to define before sharing common.protocol
+class OldMsgType(Enum):
+    DATA = 0
+    REQUEST = 1
+    ACK = 2
+    ERROR = 3
+
+# Method to encode a message the way the programs did before sharing common.protocol
+def old_encode_msg(is_last_block, msgtype, ack_block, payload):
+    is_last_block_id = 0x10 if is_last_block else 0
+    metadata = is_last_block_id + msgtype.value
+
+    struct_fmt = "{}s".format(len(payload))
+
+    msg = pack('B', metadata)
+    msg += pack('I', ack_block)
+    msg += pack(struct_fmt, payload)
+
+    return msg
+
+# Method to decode a message the way the programs did before sharing common.protocol
+def old_decode_msg(msg):
+    metadata = unpack('B', msg[:1])[0]
+    ack_block = unpack('I', msg[1:5])[0]
+    payload = msg[5:]
+
+    msgtype_mask = 0x0F
+    lastblock_mask = 0x10
+
+    is_last_block = metadata & lastblock_mask == 0x10
+    msgtype = OldMsgType(metadata & msgtype_mask)
+
+    return is_last_block, msgtype, ack_block, payload
+
+
+# Class encoding into one preallocated buffer with pack_into, measured as an alternative to encode_msg
+class PreallocatedBuffer:
+    def __init__(self):
+        self.buf = bytearray(HEADER.size + BLOCK_SIZE)
+        self.view = memoryview(self.buf)
+
+    def encode(self, is_last_block, msgtype, block, payload):
+        metadata = LASTBLOCK_MASK | msgtype.value if is_last_block else msgtype.value
+        HEADER.pack_into(self.buf, 0, metadata, block)
+        end = HEADER.size + len(payload)
+        self.buf[HEADER.size:end] = payload
+        return self.view[:end]
+
+# Method to decode into a payload memoryview instead of a bytes copy, measured as an alternative to decode_msg
+def view_decode_msg(msg):
+    metadata, block = HEADER.unpack_from(msg)
+    return metadata & LASTBLOCK_MASK != 0, MSGTYPES[metadata & MSGTYPE_MASK], block, memoryview(msg)[HEADER.size:]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare packets per second of the old and the shared message codec")
+    parser.add_argument('--count', type=int, required=False, default=200000, help='number of messages per measurement')
+    args = parser.parse_args()
+
+    payload = bytes(range(BLOCK_SIZE))
+    view = memoryview(payload)      # what common.blocks hands to the servers
+    msg = encode_msg(False, MsgType.DATA, 1234, payload)
+    buffer = PreallocatedBuffer()
+    assert old_encode_msg(False, OldMsgType.DATA, 1234, payload) == msg == buffer.encode(False, MsgType.DATA, 1234, view)
+
+    cases = [
+        ('encode, before', lambda: old_encode_msg(False, OldMsgType.DATA, 1234, payload)),
+        ('encode, encode_msg', lambda: encode_msg(False, MsgType.DATA, 1234, view)),
+        ('encode, pack_into', lambda: buffer.encode(False, MsgType.DATA, 1234, view)),
+        ('decode, before', lambda: old_decode_msg(msg)),
+        ('decode, decode_msg', lambda: decode_msg(msg)),
+        ('decode, memoryview', lambda: view_decode_msg(msg)),
+    ]
+
+    print("%-20s %15s" % ('case', 'packets/s'))
+    for name, case in cases:
+        seconds = min(timeit(case, number=args.count) for _ in range(3))
+        print("%-20s %15.0f" % (name, args.count / seconds))
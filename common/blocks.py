@@ -0,0 +1,193 @@
+# Block sources that servers slice the files they send into
+from bisect import bisect_right
+from itertools import accumulate
+from mmap import mmap, ACCESS_READ
+from os import fstat
+from os.path import join
+import zlib
+
+from common.batch import batch_chunks, decode_manifest, is_confined
+from common.delta import byte_ranges, decode_ranges, signature
+from common.protocol import BLOCK_SIZE
+
+# Class that memory-maps a file and hands out its blocks as memoryview slices, without reading or copying them,
+# or slices the contents of the file some FileCache already holds
+class BlockSource:
+    def __init__(self, path, block_size=BLOCK_SIZE, data=None):
+        self.block_size = block_size
+        if data is not None:
+            self.size, self.map = len(data), None
+        else:
+            with open(path, 'rb') as f:
+                self.size = fstat(f.fileno()).st_size
+                self.map = mmap(f.fileno(), 0, access=ACCESS_READ) if self.size else None   # empty files cannot be mapped
+        self.view = memoryview(data if data is not None else self.map or b'')
+        self.count = max(1, -(-self.size // block_size))    # an empty file is sent as one empty block
+
+    # Method to get block n [numbered from 1]
+    def block(self, n):
+        start = (n - 1) * self.block_size
+        return self.view[start:start + self.block_size]
+
+    def is_last(self, n):
+        return n >= self.count
+
+    # Method to let go of the blocks before n [nothing to do, they are slices of the map]
+    def release(self, n):
+        pass
+
+    def close(self):
+        self.view.release()
+        if self.map:
+            try:
+                self.map.close()
+            except BufferError:     # blocks still referenced elsewhere, the map is closed once they are freed
+                pass
+
+
+# Class that cuts a stream generated as it is consumed into blocks as they are first asked for,
+# optionally through zlib, keeping only the blocks that were not released yet
+class StreamBlockSource:
+    def __init__(self, chunks, first=1, compress=False, block_size=BLOCK_SIZE, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.block_size = block_size
+        self.chunks = chunks        # iterator of the bytes of the stream, None once exhausted
+        self.compressed = compress
+        self.compressor = zlib.compressobj(level) if compress else None
+        self.pending = bytearray()  # bytes not cut into a block yet
+        self.blocks = {}            # block -> payload, until released
+        self.next = first           # number of the next block to be cut
+        self.last = None            # known once the stream ended and pending is empty
+        self.file_bytes = 0         # stream bytes before compression
+
+    # Method to cut the next block, generating and compressing more of the stream as needed
+    def produce(self):
+        while len(self.pending) < self.block_size and self.chunks is not None:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                if self.compressor:
+                    self.pending += self.compressor.flush()
+                self.chunks = None
+            else:
+                self.file_bytes += len(chunk)
+                self.pending += self.compressor.compress(chunk) if self.compressor else chunk
+        self.blocks[self.next] = bytes(self.pending[:self.block_size])
+        del self.pending[:self.block_size]
+        if self.chunks is None and not self.pending:
+            self.last = self.next
+        self.next += 1
+
+    # Method to get block n, which must not be released and may not lie beyond the last block
+    def block(self, n):
+        while n >= self.next:
+            self.produce()
+        return self.blocks[n]
+
+    def is_last(self, n):
+        self.block(n)
+        return n == self.last
+
+    # Method to forget the blocks before n, once the client acknowledged them
+    def release(self, n):
+        for old in [b for b in self.blocks if b < n]:
+            del self.blocks[old]
+
+    def close(self):
+        pass
+
+
+# Class that streams a file from a byte offset through zlib
+class CompressedBlockSource(StreamBlockSource):
+    CHUNK = 4096            # file bytes read per step of the compressor
+
+    def __init__(self, path, offset=0, first=1, block_size=BLOCK_SIZE, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.file = open(path, 'rb')
+        self.size = fstat(self.file.fileno()).st_size
+        self.file.seek(offset)
+        super().__init__(iter(lambda: self.file.read(self.CHUNK), b''), first, True, block_size, level)
+
+    def close(self):
+        self.file.close()
+
+
+# Class that hands out the blocks of some bytes held in memory, such as the signature of a file
+class MemoryBlockSource:
+    def __init__(self, data, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.data = data
+        self.size = len(data)
+        self.count = max(1, -(-self.size // block_size))
+
+    def block(self, n):
+        start = (n - 1) * self.block_size
+        return self.data[start:start + self.block_size]
+
+    def is_last(self, n):
+        return n >= self.count
+
+    def release(self, n):
+        pass
+
+    def close(self):
+        pass
+
+
+# Class that sends some (start, end) byte ranges of a file back to back, as if they were one file
+class RangeBlockSource(BlockSource):
+    def __init__(self, path, ranges, block_size=BLOCK_SIZE, data=None):
+        super().__init__(path, block_size, data)
+        self.ranges = ranges
+        self.starts = [0] + list(accumulate(end - start for start, end in ranges))  # stream offset of each range
+        self.count = max(1, -(-self.starts[-1] // block_size))
+
+    # Method to get block n of the stream, joined from the ranges it spans
+    def block(self, n):
+        start, end = (n - 1) * self.block_size, min(n * self.block_size, self.starts[-1])
+        pieces = []
+        i = bisect_right(self.starts, start) - 1
+        while start < end:
+            offset = self.ranges[i][0] + start - self.starts[i]
+            length = min(end, self.starts[i + 1]) - start
+            pieces.append(self.view[offset:offset + length])
+            start += length
+            i += 1
+        return b''.join(pieces)
+
+
+# Method to open the blocks of the file filename in root for a client that already holds blocks 1..held,
+# as the REQUEST options ask for them: compressed [z=1], the file's signature [sig=1], only some chunk
+# ranges of it [r=...] or the framed files of a manifest [b=1], from a FileCache when one is given
+# [raises FileNotFoundError for a name outside root, ValueError when held lies beyond the end of the file or
+# the options are malformed]
+def open_source(root, filename, held=0, options={}, cache=None):
+    if options.get('b') == '1':
+        if held:
+            raise ValueError('only whole-file transfers can be resumed')
+        chunks = batch_chunks(root, decode_manifest(filename), options.get('g') == '1')
+        return StreamBlockSource(chunks, compress=options.get('z') == '1')
+    if not is_confined(root, filename):     # served as if it did not exist, like a batch name
+        raise FileNotFoundError(filename)
+    path = join(root, filename)
+    with open(path, 'rb') as f:
+        size = fstat(f.fileno()).st_size
+    if held and held * BLOCK_SIZE >= size:
+        raise ValueError('resume point is beyond the end of the file')
+    if held and ('sig' in options or 'r' in options):
+        raise ValueError('only whole-file transfers can be resumed')
+    if options.get('sig') == '1':
+        return MemoryBlockSource(cache.get(path, 'sig', signature) if cache else signature(path))
+    data = cache.get(path) if cache else None   # None for a file the cache cannot hold, which is mapped instead
+    if 'r' in options:
+        try:
+            chunks, chunk_blocks = decode_ranges(options['r']), int(options['c'])
+        except (KeyError, ValueError):
+            chunks, chunk_blocks = None, 0
+        if chunk_blocks < 1 or any(a > b for a, b in chunks):
+            raise ValueError('malformed chunk ranges')
+        return RangeBlockSource(path, byte_ranges(chunks, chunk_blocks, size), data=data)
+    if options.get('z') == '1':     # the compressed stream of the rest of the file is numbered on from held + 1
+        if data is not None:
+            rest = memoryview(data)[held * BLOCK_SIZE:]
+            chunks = (rest[i:i + CompressedBlockSource.CHUNK] for i in range(0, len(rest), CompressedBlockSource.CHUNK))
+            return StreamBlockSource(chunks, held + 1, compress=True)
+        return CompressedBlockSource(path, held * BLOCK_SIZE, held + 1)
+    return BlockSource(path, data=data)
@@ -0,0 +1,60 @@
+# Process-wide cache of what servers make of the files they serve, shared by every session
+#
+# A file fetched by many clients, or fetched again after a failed attempt, is read (or
+# hashed into its signature) once and then served from memory.  Entries are keyed by kind
+# and path, and are only used while the file still has the mtime and size it had when it
+# was read; the least recently used entries are evicted once the contents exceed the budget.
+from collections import OrderedDict
+from os import stat
+
+
+# Method to read a whole file, what the cache keeps of a file served as it is
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# Class that keeps the contents of recently served files within a budget of bytes, evicting the least recently used
+class FileCache:
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict()    # (kind, path) -> (mtime_ns, size, data), least recently used first
+        self.used = 0                   # bytes of data held
+        self.hits = self.misses = self.evictions = 0
+
+    # Method to get load(path), the data of the given kind made of the file at path, from memory while
+    # the file is unchanged, or None without reading anything when the contents of the file itself
+    # [kind None] could not fit into the budget [raises what os.stat or load raise for a missing file]
+    def get(self, path, kind=None, load=read_file):
+        st = stat(path)
+        if kind is None and st.st_size > self.budget:   # served from disk instead, as without a cache
+            self.misses += 1
+            return None
+        key = (kind, path)
+        entry = self.entries.get(key)
+        if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        if entry is not None:               # the file changed since it was read
+            self.discard(key)
+        data = load(path)
+        if len(data) <= self.budget:        # data of another kind larger than the budget is served but not kept
+            self.entries[key] = (st.st_mtime_ns, st.st_size, data)
+            self.used += len(data)
+            while self.used > self.budget:
+                self.discard(next(iter(self.entries)))
+                self.evictions += 1
+        return data
+
+    def discard(self, key):
+        self.used -= len(self.entries.pop(key)[2])
+
+    def summary(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.used, 'budget': self.budget}
+
+    # Method to format the counters for printing after a session
+    def report(self):
+        return "cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions, %(entries)d files in %(bytes)d of %(budget)d bytes" % self.summary()
@@ -0,0 +1,55 @@
+# Resume state of a download, kept next to the output file while it is incomplete
+#
+# <output>.part records how many blocks of the file, a contiguous prefix of it, are
+# known to be in the output; it exists only while the download is unfinished.  Blocks
+# a client wrote beyond that prefix are cut off before resuming.
+import os
+
+from common.protocol import BLOCK_SIZE
+
+
+# Class that opens the output of a download, resuming after the blocks a previous attempt left behind
+class Checkpoint:
+    def __init__(self, output_path, block_size=BLOCK_SIZE, every=64):
+        self.output_path, self.block_size, self.every = output_path, block_size, every
+        self.path = output_path + '.part'
+        self.held = 0           # blocks 1..held of the file are in the output
+        self.saved = 0          # held as of the last save
+
+    # Method to open the output, truncated to the checkpointed prefix, or created empty for a new download
+    def open(self):
+        try:
+            with open(self.path) as f:
+                recorded = int(f.read().strip() or 0)
+            f = open(self.output_path, 'r+b')
+        except (FileNotFoundError, ValueError):
+            recorded, f = 0, open(self.output_path, 'wb')
+        f.seek(0, os.SEEK_END)
+        self.held = min(recorded, f.tell() // self.block_size)   # a crash may have lost unflushed blocks
+        f.truncate(self.held * self.block_size)
+        f.seek(0, os.SEEK_END)
+        self.save(self.held, f)
+        return f
+
+    # Method to record that blocks 1..held are on disk, flushed first so the record never runs ahead of the data
+    def save(self, held, f):
+        f.flush()
+        os.fsync(f.fileno())
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as c:
+            c.write('%d\n' % held)
+        os.replace(tmp, self.path)
+        self.held = self.saved = held
+
+    # Method to note progress, saved every few blocks
+    def update(self, held, f):
+        self.held = held
+        if held - self.saved >= self.every:
+            self.save(held, f)
+
+    # Method to forget the checkpoint once the download is complete
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
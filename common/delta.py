@@ -0,0 +1,97 @@
+# Delta sync: bringing a local copy of a file up to date by fetching only the chunks that differ
+#
+# The client first gets the file's signature, a header and the digest of every chunk of
+# CHUNK_BLOCKS blocks, then asks for the ranges of chunks whose digest differs from its copy.
+# The server sends those chunks back to back and the client writes them in place, so the
+# bytes on the wire grow with the size of the change rather than the size of the file.
+from hashlib import blake2b
+from struct import Struct
+
+from common.protocol import BLOCK_SIZE, check_request, encode_request
+
+CHUNK_BLOCKS = 64                       # blocks per chunk, 6080 bytes
+DIGEST_SIZE = 8
+SIGNATURE_HEADER = Struct('=QI')        # file size, blocks per chunk
+
+
+def digest(data):
+    return blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+# Method to compute the signature of a file
+def signature(path, chunk_blocks=CHUNK_BLOCKS):
+    chunk_size = chunk_blocks * BLOCK_SIZE
+    digests = []
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            size += len(chunk)
+            digests.append(digest(chunk))
+    return SIGNATURE_HEADER.pack(size, chunk_blocks) + b''.join(digests)
+
+# Method to decode a signature into the file size, blocks per chunk and the chunk digests
+def parse_signature(data):
+    size, chunk_blocks = SIGNATURE_HEADER.unpack_from(data)
+    body = data[SIGNATURE_HEADER.size:]
+    return size, chunk_blocks, [bytes(body[i:i + DIGEST_SIZE]) for i in range(0, len(body), DIGEST_SIZE)]
+
+# Method to list the chunks of the local copy that differ from the signature, as (first, last) ranges
+def changed_ranges(path, chunk_blocks, digests):
+    chunk_size = chunk_blocks * BLOCK_SIZE
+    ranges = []
+    with open(path, 'rb') as f:
+        for i, remote in enumerate(digests):
+            if digest(f.read(chunk_size)) == remote:
+                continue
+            if ranges and ranges[-1][1] == i - 1:
+                ranges[-1] = (ranges[-1][0], i)
+            else:
+                ranges.append((i, i))
+    return ranges
+
+def encode_ranges(ranges):
+    return '.'.join('%d' % a if a == b else '%d-%d' % (a, b) for a, b in ranges)
+
+def decode_ranges(text):
+    ranges = []
+    for item in text.split('.'):
+        a, _, b = item.partition('-')
+        ranges.append((int(a), int(b or a)))
+    return ranges
+
+# Method to merge the ranges closest together until the REQUEST asking for them fits into one message
+# [raises ValueError when even a single range does not fit]
+def fit_ranges(filename, ranges, options):
+    ranges = list(ranges)
+    while len(ranges) > 1 and len(encode_request(filename, r=encode_ranges(ranges), **options)) > BLOCK_SIZE:
+        i = min(range(len(ranges) - 1), key=lambda i: ranges[i + 1][0] - ranges[i][1])
+        ranges[i:i + 2] = [(ranges[i][0], ranges[i + 1][1])]
+    if ranges:
+        check_request(encode_request(filename, r=encode_ranges(ranges), **options))
+    return ranges
+
+# Method to convert chunk ranges to the (start, end) byte ranges of a file of the given size
+def byte_ranges(ranges, chunk_blocks, size):
+    chunk_size = chunk_blocks * BLOCK_SIZE
+    return [(a * chunk_size, min((b + 1) * chunk_size, size)) for a, b in ranges if a * chunk_size < size]
+
+
+# Class that writes the concatenated bytes of some ranges of a file to where they belong
+class RangeWriter:
+    def __init__(self, f, ranges):
+        self.f = f
+        self.ranges = list(ranges)      # (start, end) byte ranges still to be filled
+        self.written = 0
+
+    def write(self, data):
+        data = memoryview(data)
+        while data:
+            start, end = self.ranges[0]
+            n = min(len(data), end - start)
+            self.f.seek(start)
+            self.f.write(data[:n])
+            data = data[n:]
+            self.written += n
+            if start + n == end:
+                self.ranges.pop(0)
+            else:
+                self.ranges[0] = (start + n, end)
@@ -0,0 +1,95 @@
+# Forward error correction: an XOR parity of every group of K blocks, so the client can rebuild
+# one lost block per group without waiting for its retransmission
+#
+# Groups hold full blocks only: the group that reaches the last block of a transfer, which may
+# be short, gets no parity.  A PARITY names the first block of its group and carries log2 K in
+# its flags, so K can change from one group to the next.
+from math import sqrt
+
+from common.protocol import BLOCK_SIZE
+
+MAX_K = 128                 # 2 ** 7, the largest K the 3 flag bits can carry
+
+
+# Method to choose K for a loss rate: the largest power of 2 up to max_k at which a group of
+# K blocks and its parity is expected to lose at most one message
+def k_for_loss(loss, max_k=32):
+    k = 2
+    while k * 2 <= max_k and (k * 2 + 1) * loss <= 1.0:
+        k *= 2
+    return k
+
+
+# Method to parse the K of --fec: a power of 2 from 2 to MAX_K, or auto
+def fec_group(text):
+    if text == 'auto':
+        return text
+    k = int(text)
+    if k < 2 or k > MAX_K or k & (k - 1):
+        raise ValueError('K must be a power of 2 from 2 to %d' % MAX_K)
+    return k
+
+
+# Class that XORs each group of K blocks into a PARITY as the blocks are first sent, in order
+class ParityEncoder:
+    SETTLE = 32             # acknowledged blocks before an adaptive encoder trusts the loss rate
+    def __init__(self, k=4, adaptive=False, block_size=BLOCK_SIZE):
+        self.k, self.adaptive, self.block_size = k, adaptive, block_size
+        self.first = None       # first block of the group being built, None between groups
+        self.group_k = k
+        self.acc = 0
+
+    # Method to let an adaptive encoder choose K for the next group from the blocks lost of those acknowledged
+    # so far, keeping its initial K until there are enough of them.  A block counts as lost when its DATA
+    # or its ACK was, and both directions are taken to lose alike
+    def adapt(self, lost, acked):
+        if self.adaptive and acked >= self.SETTLE:
+            self.k = k_for_loss(1 - sqrt(1 - min(lost / acked, 0.99)))
+
+    # Method to add a block sent for the first time, returns (first block, log2 K, payload)
+    # of the PARITY of the group it completes, or None
+    def add(self, block, payload, is_last):
+        if is_last or len(payload) != self.block_size:
+            self.first = None
+            return None
+        if self.first is None:
+            self.first, self.group_k, self.acc = block, self.k, 0
+        self.acc ^= int.from_bytes(payload, 'little')
+        if block - self.first + 1 < self.group_k:
+            return None
+        self.first = None
+        return block - self.group_k + 1, self.group_k.bit_length() - 1, self.acc.to_bytes(self.block_size, 'little')
+
+
+# Class that keeps the blocks a parity may need and rebuilds the one block a group lacks
+class ParityDecoder:
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.recent = {}        # block -> payload of blocks received, at most MAX_K below the next one to write
+        self.parities = {}      # first block -> (K, parity) of groups that may still lack a block
+
+    def add_block(self, block, payload):
+        self.recent[block] = payload
+
+    def add_parity(self, first, k, payload):
+        self.parities[first] = (k, int.from_bytes(payload, 'little'))
+
+    # Method to forget what no group with a block at or after expected can need
+    def forget(self, expected):
+        self.recent.pop(expected - MAX_K - 1, None)
+        for first in [f for f, (k, _) in self.parities.items() if f + k <= expected]:
+            del self.parities[first]
+
+    # Method to rebuild a block in [lo, hi) that is the only one its group lacks, returns (block, payload) or None
+    def recover(self, lo, hi):
+        for first, (k, parity) in list(self.parities.items()):
+            missing = [b for b in range(first, first + k) if b not in self.recent]
+            if not missing:
+                del self.parities[first]
+            elif len(missing) == 1 and lo <= missing[0] < hi:
+                del self.parities[first]
+                for b in range(first, first + k):
+                    if b != missing[0]:
+                        parity ^= int.from_bytes(self.recent[b], 'little')
+                return missing[0], parity.to_bytes(self.block_size, 'little')
+        return None
@@ -0,0 +1,117 @@
+# Sender pacing: spacing messages out at the bottleneck rate instead of bursting a window
+#
+# A burst of a whole window overflows a bottleneck queue of a few messages.  Pacing sends
+# each message only once a token bucket, refilled at the pacing rate, holds its bytes.  The
+# rate is either given, or estimated by packet pair: two messages sent back to back leave the
+# bottleneck one transmission time apart, and their ACKs come back that far apart.  Until
+# the first estimate the sender is allowed two messages per ACK, so it starts with pairs, and
+# after it every PAIR_EVERY-th message is followed by the next at once, so the estimate keeps
+# measuring the bottleneck rather than the pacing.
+
+
+# Class that estimates the bottleneck rate from the dispersion of the ACKs of messages sent close together
+class PacketPair:
+    SAMPLES = 9             # samples the median is taken over
+    SPREAD = 0.5            # sends at most this fraction of their ACK gap apart make a pair
+
+    def __init__(self):
+        self.last = None        # (ACK arrival, send time) of the previous ACK
+        self.samples = []
+        self.rate = None        # bytes/second, once there is a sample
+
+    # Method to take the ACK of a message of nbytes sent at sent_at [None when it was sent more than once],
+    # returns True when it yielded a sample
+    def on_ack(self, now, nbytes, sent_at):
+        last, self.last = self.last, (now, sent_at) if sent_at is not None else None
+        if last is None or sent_at is None:
+            return False
+        ack_gap, send_gap = now - last[0], abs(sent_at - last[1])
+        if ack_gap <= 0 or send_gap > ack_gap * self.SPREAD:    # spaced by the sender, not by the bottleneck
+            return False
+        self.samples = self.samples[-(self.SAMPLES - 1):] + [nbytes / ack_gap]
+        self.rate = sorted(self.samples)[len(self.samples) // 2]
+        return True
+
+
+# Class that releases bytes at a rate, allowing a burst of at most depth bytes after an idle period
+class TokenBucket:
+    SLACK = 1e-6            # bytes short of a message that still count as enough, so the time next_time gives is never missed by rounding
+
+    def __init__(self, rate, depth, now=None):
+        self.rate, self.depth = rate, depth
+        self.tokens = depth
+        self.updated = now
+
+    def refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.depth, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Method to check whether nbytes may be sent now
+    def ready(self, now, nbytes):
+        self.refill(now)
+        return self.tokens + self.SLACK >= nbytes
+
+    # Method to take the tokens of nbytes sent, going into debt for a retransmission that could not wait
+    def consume(self, now, nbytes):
+        self.refill(now)
+        self.tokens -= nbytes
+
+    # Method to get the time nbytes may be sent
+    def next_time(self, nbytes):
+        return self.updated + max(0.0, nbytes - self.tokens) / self.rate
+
+
+# Class that paces a sender at a fixed rate, or at the packet pair estimate of the bottleneck rate
+class Pacer:
+    PAIR_EVERY = 8          # messages between the pairs that keep the estimate up to date
+
+    def __init__(self, rate=None, burst=200):
+        self.burst = burst      # bytes that may leave back to back
+        self.estimate = PacketPair() if rate is None else None
+        self.bucket = TokenBucket(rate, burst) if rate is not None else None
+        self.credit = 2         # new messages that may be sent before the next ACK, until there is a rate
+        self.since_pair = 0     # messages sent since the last pair
+        self.pair_next = False  # the next message may follow the last one at once
+
+    @property
+    def rate(self):
+        return self.bucket.rate if self.bucket else None
+
+    # Method to check whether a message of nbytes may be sent now
+    def ready(self, now, nbytes):
+        if self.bucket is None:
+            return self.credit > 0
+        return self.pair_next or self.bucket.ready(now, nbytes)
+
+    # Method to let a sender with nothing in flight, whose credit went to messages that were lost, send a pair again
+    def restart(self):
+        if self.bucket is None:
+            self.credit = max(self.credit, 2)
+
+    # Method to count a message sent, new for a block sent for the first time rather than a retransmission or parity
+    def on_send(self, now, nbytes, new=True):
+        if self.bucket is None:
+            self.credit -= new
+            return
+        self.bucket.consume(now, nbytes)    # a pair's second message goes into debt, paid back by the gap after it
+        if self.estimate is None or not new:
+            return
+        self.since_pair = 0 if self.pair_next else self.since_pair + 1
+        self.pair_next = self.since_pair >= self.PAIR_EVERY
+
+    # Method to take the ACK of a message of nbytes sent at sent_at, None when it was sent more than once
+    def on_ack(self, now, nbytes, sent_at):
+        if self.estimate is None or not self.estimate.on_ack(now, nbytes, sent_at):
+            if self.bucket is None:
+                self.credit += 2
+            return
+        if self.bucket is None:
+            self.bucket = TokenBucket(self.estimate.rate, self.burst, now)
+        else:
+            self.bucket.refill(now)
+            self.bucket.rate = self.estimate.rate
+
+    # Method to get the time a message of nbytes may be sent, None while sending waits for ACKs instead
+    def next_time(self, nbytes):
+        return self.bucket.next_time(nbytes) if self.bucket else None
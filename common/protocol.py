@@ -0,0 +1,119 @@
+# Message layout shared by the stop-and-wait and sliding window clients and servers
+#
+#   byte 0      metadata: the top 3 bits are flags of the MsgType, 0x10 flags the last block,
+#               the low nibble is the MsgType
+#   bytes 1-4   block number
+#   bytes 5-99  payload
+#
+# A PARITY carries the XOR of the K full DATA blocks from its block number on, with log2 K
+# in its flags; an ACK with flags 1 acknowledges a block the client rebuilt from a PARITY.  A
+# DATA of the stop-and-wait server with flags 1 is a retransmission, which the client must not
+# take an RTT sample from (Karn's rule).
+#
+# An ACK of the sliding window client carries a SACK payload: the cumulative ACK, the last
+# block of the in-order prefix it holds, then a bitmap of the blocks it holds beyond that
+# (see encode_sack).  A NACK names the first block of a gap the client just saw, with a bitmap
+# of the other missing blocks after it, so the server can resend them at once.
+#
+# A REQUEST carries the file name and options (see encode_request) in its payload, and in
+# its block number how many blocks of the file the client already holds.  Options:
+#
+#   z=1         the server sends the zlib compressed stream of the file instead of the file
+#   sig=1       the server sends the signature of the file (see common/delta.py)
+#   r=..,c=N    the server sends only the ranges of chunks of N blocks listed in r,
+#               back to back, as dot separated first[-last] chunk numbers from 0
+#   b=1         the file name is a newline separated manifest of names, sent back to back as
+#               framed files (see common/batch.py); with g=1 the names are glob patterns
+from enum import Enum
+from struct import Struct
+
+MAX_MSG = 100                           # longest datagram the protocol may send
+HEADER = Struct('=BI')                  # metadata byte and block number, without padding
+BLOCK_SIZE = MAX_MSG - HEADER.size      # payload bytes per message
+
+MSGTYPE_MASK = 0x0F
+LASTBLOCK_MASK = 0x10
+FLAGS_SHIFT = 5
+ACK_RECOVERED = 1                       # flags of the ACK of a block rebuilt from a PARITY
+DATA_RETRANSMITTED = 1                  # flags of a DATA the stop-and-wait server sent again
+SACK = Struct('=I')                     # cumulative ACK at the front of an ACK payload
+
+# Enum class used to specify the type of a message
+class MsgType(Enum):
+    DATA = 0
+    REQUEST = 1
+    ACK = 2
+    ERROR = 3
+    PARITY = 4
+    NACK = 5
+
+# metadata nibble -> MsgType, so decoding is an index instead of an Enum lookup; unknown types map to None
+MSGTYPES = tuple({t.value: t for t in MsgType}.get(v) for v in range(MSGTYPE_MASK + 1))
+
+
+# Method to encode a message before sending it [a payload memoryview is copied once, into the datagram]
+def encode_msg(is_last_block, msgtype, block, payload, flags=0):
+    metadata = LASTBLOCK_MASK | msgtype.value if is_last_block else msgtype.value
+    return HEADER.pack(metadata | flags << FLAGS_SHIFT, block) + payload
+
+# Method to decode a received message [raises ValueError for a datagram shorter than the header]
+def decode_msg(msg):
+    if len(msg) < HEADER.size:
+        raise ValueError('message shorter than its header')
+    metadata, block = HEADER.unpack_from(msg)
+    return metadata & LASTBLOCK_MASK != 0, MSGTYPES[metadata & MSGTYPE_MASK], block, msg[HEADER.size:]
+
+
+# Method to get the flags of a message, which decode_msg leaves out
+def msg_flags(msg):
+    return msg[0] >> FLAGS_SHIFT
+
+
+# Method to encode the blocks after base as a bitmap, bit i of byte j standing for block base + 1 + 8*j + i,
+# leaving out the blocks beyond what nbytes can hold
+def encode_bitmap(base, blocks, nbytes=BLOCK_SIZE):
+    bits = 0
+    for block in blocks:
+        if base < block <= base + nbytes * 8:
+            bits |= 1 << (block - base - 1)
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+# Method to decode a bitmap into the list of the blocks after base it holds
+def decode_bitmap(base, data):
+    bits = int.from_bytes(data, 'little')
+    return [base + 1 + i for i in range(bits.bit_length()) if bits >> i & 1]
+
+# Method to encode the payload of an ACK: the cumulative ACK and the blocks held beyond it
+def encode_sack(cumulative, blocks):
+    return SACK.pack(cumulative) + encode_bitmap(cumulative + 1, blocks, BLOCK_SIZE - SACK.size)   # block cumulative + 1 is missing
+
+# Method to decode the payload of an ACK into the cumulative ACK and the blocks held beyond it,
+# None for an ACK without one
+def decode_sack(payload):
+    if len(payload) < SACK.size:
+        return None
+    cumulative, = SACK.unpack_from(payload)
+    return cumulative, decode_bitmap(cumulative + 1, payload[SACK.size:])
+
+
+# Method to encode the payload of a REQUEST: the file name, then a NUL and comma separated key=value options
+def encode_request(filename, **options):
+    payload = filename.encode()
+    if options:
+        payload += b'\0' + ','.join('%s=%s' % item for item in sorted(options.items())).encode()
+    return payload
+
+# Method to pass on the payload of a REQUEST that fits into one message [raises ValueError for a longer one]
+def check_request(payload):
+    if len(payload) > BLOCK_SIZE:
+        raise ValueError('file name and options too long for a REQUEST (%d of %d bytes)' % (len(payload), BLOCK_SIZE))
+    return payload
+
+# Method to decode the payload of a REQUEST into the file name and a dict of its options
+# [raises ValueError for a payload that is not UTF-8]
+def decode_request(payload):
+    try:
+        filename, _, options = bytes(payload).decode().partition('\0')
+    except UnicodeDecodeError:
+        raise ValueError('file name is not UTF-8') from None
+    return filename, dict(option.partition('=')[::2] for option in options.split(',') if option)
@@ -0,0 +1,77 @@
+# Receive-side writer putting the blocks of a file in place as they arrive, in any order
+#
+# Each block is written with os.pwrite at its offset, (block - 1) * BLOCK_SIZE, so a block
+# that arrives ahead of a gap costs no memory until the gap is filled.  Runs of consecutive
+# blocks are gathered into one write of up to COALESCE blocks, and a bitmap records which
+# blocks are on disk.  The protocol carries no file size, so the file is preallocated in
+# EXTENT steps ahead of the blocks written and cut to its size once the last block is in.
+import os
+
+from common.protocol import BLOCK_SIZE
+
+
+# Class that writes blocks at their offsets into an output opened for writing in binary mode
+class BlockWriter:
+    COALESCE = 64           # consecutive blocks gathered into one write
+    EXTENT = 1 << 20        # bytes preallocated at a time
+
+    def __init__(self, f, first=1, block_size=BLOCK_SIZE):
+        self.f, self.fd, self.block_size = f, f.fileno(), block_size
+        self.first = first          # first block expected, the ones before it are already in the output
+        self.bitmap = bytearray()   # bit block - first is set once the block is written
+        self.prefix = first - 1     # blocks 1..prefix are written
+        self.run_start = None       # first of the consecutive blocks gathered for the next write
+        self.run = []
+        self.allocated = os.fstat(self.fd).st_size
+        self.last = self.size = None    # last block and file size, known once the last block arrived
+
+    def fileno(self):
+        return self.fd
+
+    # Method to write block n, at once or gathered with the blocks before it
+    def add(self, n, payload, is_last=False):
+        if self.run and (n != self.run_start + len(self.run) or len(self.run) == self.COALESCE):
+            self.flush()
+        if not self.run:
+            self.run_start = n
+        self.run.append(bytes(payload))
+        if is_last:
+            self.last, self.size = n, (n - 1) * self.block_size + len(payload)
+            self.flush()
+
+    def is_written(self, n):
+        i = n - self.first
+        return i < 0 or i // 8 < len(self.bitmap) and self.bitmap[i // 8] >> i % 8 & 1
+
+    # Method to write the gathered blocks in one pwrite
+    def flush(self):
+        if not self.run:
+            return
+        data = b''.join(self.run)
+        offset = (self.run_start - 1) * self.block_size
+        self.preallocate(offset + len(data))
+        os.pwrite(self.fd, data, offset)
+        for n in range(self.run_start, self.run_start + len(self.run)):
+            i = n - self.first
+            if i // 8 >= len(self.bitmap):
+                self.bitmap.extend(bytes(i // 8 + 1 - len(self.bitmap)))
+            self.bitmap[i // 8] |= 1 << i % 8
+        self.run = []
+        while self.is_written(self.prefix + 1):
+            self.prefix += 1
+
+    # Method to reserve disk space up to end and a step beyond it, or up to the file size once it is known
+    def preallocate(self, end):
+        if end <= self.allocated or not hasattr(os, 'posix_fallocate'):
+            return
+        target = self.size if self.size is not None else end + self.EXTENT
+        os.posix_fallocate(self.fd, self.allocated, target - self.allocated)
+        self.allocated = target
+
+    # Method to write what is gathered and cut the output to the file's size, or to the prefix written when
+    # the download did not complete, which is what a checkpoint can resume from
+    def finish(self):
+        self.flush()
+        complete = self.last is not None and self.prefix >= self.last
+        os.ftruncate(self.fd, self.size if complete else self.prefix * self.block_size)
+        self.allocated = os.fstat(self.fd).st_size
@@ -0,0 +1,38 @@
+# Retransmission timeout estimation shared by the clients and servers
+
+# Class that turns RTT samples into a retransmission timeout [RFC 6298]
+class RttEstimator:
+    ALPHA = 1 / 8       # gain of the smoothed RTT
+    BETA = 1 / 4        # gain of the RTT variation
+    K = 4               # weight of the variation in the timeout
+    GRANULARITY = 0.001 # clock granularity in seconds
+
+    def __init__(self, initial_rto=1.0, min_rto=0.05, max_rto=60.0):
+        self.min_rto, self.max_rto = min_rto, max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.base_rto = initial_rto
+        self.backoffs = 0   # number of times the timeout expired since the last sample
+
+    @property
+    def rto(self):
+        return min(self.max_rto, self.base_rto * 2 ** self.backoffs)
+
+    # Method to add a measured RTT; callers must skip retransmitted messages [Karn's rule]
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.base_rto = max(self.min_rto, self.srtt + max(self.GRANULARITY, self.K * self.rttvar))
+        self.backoffs = 0
+
+    # Method to double the timeout after it expired
+    def backoff(self):
+        self.backoffs += 1
+
+    # Method to undo the backoff when the peer is heard from again without a usable sample
+    def reset_backoff(self):
+        self.backoffs = 0
@@ -0,0 +1,161 @@
+# Transfer statistics reported by the clients and servers
+import csv
+import json
+
+
+# Class that counts the events of one transfer and optionally records them as a time series
+class TransferStats:
+    def __init__(self, record_series=False):
+        self.record_series = record_series
+        self.series = []        # (seconds since the first phase, event, block, value)
+        self.phases = []        # (phase name, time it was entered)
+        self.rtts = []
+        self.payload_bytes = 0  # unique file bytes delivered or acknowledged, for goodput
+        self.file_bytes = None  # bytes of the file those payloads stand for, when compressed or delta synced
+        self.wire_bytes = 0     # every datagram byte sent and received, headers and repeats included
+        self.sent_msgs = self.received_msgs = 0
+        self.retransmits = self.duplicates = self.timeouts = 0
+        self.parities = 0       # PARITY messages sent or received
+        self.fec_recovered = self.rtx_recovered = 0     # lost blocks rebuilt from a parity, or resent
+        self.nacks = 0          # NACK messages sent or received
+        self.fast_retransmits = 0   # blocks resent on a NACK rather than a timeout
+        self.sacked = 0         # blocks acknowledged only by the SACK of a later ACK
+
+    def record(self, now, event, block, value):
+        if self.record_series:
+            self.series.append((now - self.phases[0][1] if self.phases else 0.0, event, block, value))
+
+    # Method to enter a phase of the transfer [request, transfer, done, ...]
+    def mark(self, now, phase):
+        self.phases.append((phase, now))
+        self.record(now, 'phase', 0, phase)
+
+    def sent(self, now, block, nbytes, retransmit=False):
+        self.sent_msgs += 1
+        self.wire_bytes += nbytes
+        if retransmit:
+            self.retransmits += 1
+        self.record(now, 'retransmit' if retransmit else 'send', block, nbytes)
+
+    def received(self, now, block, nbytes, duplicate=False):
+        self.received_msgs += 1
+        self.wire_bytes += nbytes
+        if duplicate:
+            self.duplicates += 1
+        self.record(now, 'duplicate' if duplicate else 'receive', block, nbytes)
+
+    def delivered(self, nbytes):
+        self.payload_bytes += nbytes
+
+    # Method to count file bytes a compressed or delta payload stands for
+    def expanded(self, nbytes):
+        self.file_bytes = (self.file_bytes or 0) + nbytes
+
+    def parity(self, now, block):
+        self.parities += 1
+        self.record(now, 'parity', block, 0)
+
+    # Method to count a lost block that was rebuilt from a parity, or that a retransmission replaced
+    def recovered(self, now, block, by_parity):
+        if by_parity:
+            self.fec_recovered += 1
+        else:
+            self.rtx_recovered += 1
+        self.record(now, 'fec' if by_parity else 'rtx', block, 0)
+
+    def nack(self, now, block):
+        self.nacks += 1
+        self.record(now, 'nack', block, 0)
+
+    def fast_retransmit(self, now, block):
+        self.fast_retransmits += 1
+        self.record(now, 'fast_retransmit', block, 0)
+
+    def sack(self, now, block):
+        self.sacked += 1
+        self.record(now, 'sack', block, 0)
+
+    def rtt(self, now, block, sample):
+        self.rtts.append(sample)
+        self.record(now, 'rtt', block, sample)
+
+    def timeout(self, now):
+        self.timeouts += 1
+        self.record(now, 'timeout', 0, 0)
+
+    # Method to add the counters of a transfer that ran alongside this one, such as another stripe of the file;
+    # the time series and phases stay this transfer's own
+    def absorb(self, other):
+        self.rtts += other.rtts
+        self.payload_bytes += other.payload_bytes
+        self.wire_bytes += other.wire_bytes
+        for name in ('sent_msgs', 'received_msgs', 'retransmits', 'duplicates', 'timeouts', 'parities',
+                     'fec_recovered', 'rtx_recovered', 'nacks', 'fast_retransmits', 'sacked'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def summary(self):
+        duration = self.phases[-1][1] - self.phases[0][1] if len(self.phases) > 1 else 0.0
+        rtts = sorted(self.rtts)
+        file_bytes = self.payload_bytes if self.file_bytes is None else self.file_bytes
+        phases = {}             # a phase entered more than once [one per step of a sync] adds up
+        for (name, start), (_, end) in zip(self.phases, self.phases[1:]):
+            phases[name] = phases.get(name, 0.0) + end - start
+        return {
+            'duration': duration,
+            'phases': phases,
+            'payload_bytes': self.payload_bytes,
+            'file_bytes': file_bytes,
+            'speedup': file_bytes / self.payload_bytes if self.payload_bytes else 1.0,    # file bytes per payload byte
+            'effective_goodput': file_bytes / duration if duration else 0.0,
+            'wire_bytes': self.wire_bytes,
+            'goodput': self.payload_bytes / duration if duration else 0.0,
+            'throughput': self.wire_bytes / duration if duration else 0.0,
+            'sent': self.sent_msgs,
+            'received': self.received_msgs,
+            'retransmits': self.retransmits,
+            'duplicates': self.duplicates,
+            'timeouts': self.timeouts,
+            'parities': self.parities,
+            'fec_recovered': self.fec_recovered,
+            'rtx_recovered': self.rtx_recovered,
+            'nacks': self.nacks,
+            'fast_retransmits': self.fast_retransmits,
+            'sacked': self.sacked,
+            'rtt_samples': len(rtts),
+            'rtt_min': rtts[0] if rtts else None,
+            'rtt_avg': sum(rtts) / len(rtts) if rtts else None,
+            'rtt_p99': rtts[min(len(rtts) - 1, int(len(rtts) * 0.99))] if rtts else None,
+        }
+
+    # Method to format the summary for printing at the end of a transfer
+    def report(self):
+        s = self.summary()
+        lines = ["%d bytes in %.3fs: goodput %.0f B/s, throughput %.0f B/s (%d bytes on the wire)" %
+                 (s['payload_bytes'], s['duration'], s['goodput'], s['throughput'], s['wire_bytes']),
+                 "messages sent %d, received %d, retransmits %d, duplicates %d, timeouts %d" %
+                 (s['sent'], s['received'], s['retransmits'], s['duplicates'], s['timeouts'])]
+        if self.file_bytes is not None:
+            lines.append("file: %d bytes from %d payload bytes, effective goodput %.0f B/s, speedup %.2fx" %
+                         (s['file_bytes'], s['payload_bytes'], s['effective_goodput'], s['speedup']))
+        if self.parities:
+            lines.append("FEC: %d parity messages, lost blocks recovered %d from parity and %d by retransmission" %
+                         (s['parities'], s['fec_recovered'], s['rtx_recovered']))
+        if self.nacks or self.sacked:
+            lines.append("SACK/NACK: %d NACK messages, %d blocks resent on a NACK, %d acknowledged only by a SACK" %
+                         (s['nacks'], s['fast_retransmits'], s['sacked']))
+        if s['rtt_samples']:
+            lines.append("RTT over %d samples: min %.1fms, avg %.1fms, p99 %.1fms" %
+                         (s['rtt_samples'], s['rtt_min'] * 1000, s['rtt_avg'] * 1000, s['rtt_p99'] * 1000))
+        if s['phases']:
+            lines.append("phases: " + ", ".join("%s %.3fs" % item for item in s['phases'].items()))
+        return "\n".join(lines)
+
+    # Method to write the summary and time series as JSON, or the time series as CSV when path ends in .csv
+    def write(self, path):
+        with open(path, 'w', newline='') as f:
+            if path.endswith('.csv'):
+                writer = csv.writer(f)
+                writer.writerow(('time', 'event', 'block', 'value'))
+                writer.writerows(self.series)
+            else:
+                json.dump({'summary': self.summary(), 'series': self.series}, f)
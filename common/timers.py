@@ -0,0 +1,115 @@
+# Hierarchical timer wheel: timers armed and cancelled in O(1) and expired in batches [Varghese and Lauck]
+#
+# Time is cut into ticks.  Wheel 0 has a slot for each of the next SLOTS ticks, wheel 1 a slot
+# for each of the next SLOTS spans of SLOTS ticks, and so on up.  When the current tick reaches
+# a slot of an upper wheel, its timers cascade down into the wheels below, so a timer is moved
+# at most LEVELS times before it fires.  A timer fires on the first tick at or after its
+# deadline, so at most one tick late, and ticks that no wheel has a timer for are skipped.
+from math import ceil, floor
+
+
+# Class that keeps one timer per key and hands back the keys of the timers that expired
+class TimerWheel:
+    SLOTS = 64              # slots per wheel
+    LEVELS = 4              # wheels; with 1ms ticks the top one reaches 4.6 hours ahead
+    EPSILON = 0.01          # ticks a time may fall short of a tick and still count as on it, against float rounding
+
+    def __init__(self, tick=0.001):
+        self.tick = tick
+        self.current = None     # last tick expired, set by the first arm or expire
+        self.wheels = [[{} for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]    # slot: key -> tick
+        self.counts = [0] * self.LEVELS     # timers on each wheel
+        self.where = {}         # key -> (wheel, slot), None for an overdue timer
+        self.overdue = {}       # key -> tick of timers armed for a tick that is not ahead of current
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, key):
+        return key in self.where
+
+    # Method to set the timer of key to deadline, replacing the one it had
+    def arm(self, key, deadline):
+        self.cancel(key)
+        t = ceil(deadline / self.tick - self.EPSILON)
+        if self.current is None:
+            self.current = t - 1
+        self.place(key, t)
+
+    def cancel(self, key):
+        if key not in self.where:
+            return
+        loc = self.where.pop(key)
+        if loc is None:
+            del self.overdue[key]
+        else:
+            del self.wheels[loc[0]][loc[1]][key]
+            self.counts[loc[0]] -= 1
+
+    # Method to put a timer on the lowest wheel whose slots reach its tick, the top one reaching furthest
+    def place(self, key, t):
+        if t <= self.current:
+            self.overdue[key] = t
+            self.where[key] = None
+            return
+        for level in range(self.LEVELS):
+            span = self.SLOTS ** level
+            if t // span - self.current // span < self.SLOTS:
+                break
+        slot = min(t // span, self.current // span + self.SLOTS - 1) % self.SLOTS
+        self.wheels[level][slot][key] = t
+        self.counts[level] += 1
+        self.where[key] = (level, slot)
+
+    # Method to get the time of the next tick anything happens on, an expiry or a cascade, None without timers
+    def next_deadline(self):
+        if not self.where:
+            return None
+        ticks = list(self.overdue.values())
+        for level in range(self.LEVELS):
+            if not self.counts[level]:
+                continue
+            span = self.SLOTS ** level
+            base = self.current // span
+            ticks += [(base + d) * span for d in range(1, self.SLOTS) if self.wheels[level][(base + d) % self.SLOTS]][:1]
+        return min(ticks) * self.tick
+
+    # Method to advance the wheels to now, returns the keys of every timer that expired, which are forgotten
+    def expire(self, now):
+        target = floor(now / self.tick + self.EPSILON)
+        if self.current is None:
+            self.current = target
+        expired = []
+        while self.current < target:
+            lowest = next((level for level in range(self.LEVELS) if self.counts[level]), None)
+            if lowest is None:
+                self.current = target
+                break
+            if lowest:      # nothing happens before the next cascade of that wheel
+                span = self.SLOTS ** lowest
+                self.current = min(target, (self.current // span + 1) * span - 1)
+                if self.current == target:
+                    break
+            self.current += 1
+            for level in range(self.LEVELS - 1, 0, -1):
+                span = self.SLOTS ** level
+                if self.current % span == 0:
+                    self.cascade(level, self.current // span % self.SLOTS)
+            slot = self.wheels[0][self.current % self.SLOTS]
+            if slot:
+                expired += slot
+                self.counts[0] -= len(slot)
+                for key in slot:
+                    del self.where[key]
+                slot.clear()
+        for key in [key for key, t in self.overdue.items() if t <= target]:
+            del self.overdue[key], self.where[key]
+            expired.append(key)
+        return expired
+
+    def cascade(self, level, slot):
+        timers = self.wheels[level][slot]
+        self.counts[level] -= len(timers)
+        self.wheels[level][slot] = {}
+        for key, t in timers.items():
+            self.place(key, t)
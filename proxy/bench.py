@@ -0,0 +1,140 @@
+#! /bin/python
+
+# Benchmark of the stop-and-wait and sliding window programs through udpProxy.py on loopback
+
+import argparse, csv, json, shlex, subprocess, sys, time
+from glob import glob
+from os import remove
+from os.path import abspath, dirname, exists, join
+from random import Random
+from statistics import mean
+from tempfile import TemporaryDirectory
+
+proxyDir = dirname(abspath(__file__))
+repoDir = join(proxyDir, '..')
+
+def loadProfile(name):
+    """ proxy options of a pN.sh script, without the addresses and --verbose, which the benchmark sets """
+    with open(join(proxyDir, name + ".sh")) as f:
+        line = next(l for l in f if "udpProxy.py" in l)
+    words = shlex.split(line)
+    words = words[words.index("udpProxy.py") + 1:]
+    options = []
+    while words:
+        sw = words.pop(0)
+        if sw in ("--clientPort", "--serverAddr"):
+            words.pop(0)
+        elif sw not in ("-v", "--verbose"):
+            options.append(sw)
+    return options
+
+def readSummary(pattern, seconds):
+    """ summary of the first complete stats file matching pattern, waiting up to seconds for it to be written """
+    end = time.time() + seconds
+    while True:
+        for name in glob(pattern):
+            try:
+                with open(name) as f:
+                    return json.load(f)['summary']
+            except ValueError:          # still being written
+                pass
+        if time.time() >= end:
+            return {}
+        time.sleep(0.05)
+
+def runOnce(impl, profile, fileName, data, seed, port, window, limit, tmpDir):
+    """ start proxy, server and client, transfer fileName once and return a result row """
+    clientStats, serverStats = join(tmpDir, "client.json"), join(tmpDir, "server.json")
+    for old in glob(join(tmpDir, "*.json")):
+        remove(old)
+    windowArgs = ["--window", str(window)] if impl == "sliding" else []
+    logs = open(join(tmpDir, "log.txt"), "w")
+    procs = [subprocess.Popen([sys.executable, join(proxyDir, "udpProxy.py"), "--clientPort", str(port),
+                               "--serverAddr", "localhost:%d" % (port + 1), "--seed", str(seed)] + loadProfile(profile),
+                              stdin=subprocess.DEVNULL, stdout=logs, stderr=logs),
+             subprocess.Popen([sys.executable, join(repoDir, impl, "server", "udpServer.py"), "--port", str(port + 1),
+                               "--stats", serverStats] + windowArgs,
+                              stdin=subprocess.DEVNULL, stdout=logs, stderr=logs)]
+    time.sleep(0.5)                     # let both bind their ports
+    received = join(repoDir, impl, "client", fileName)
+    start = time.time()
+    try:
+        client = subprocess.run([sys.executable, join(repoDir, impl, "client", "udpClient.py"), fileName,
+                                 "--server", "localhost:%d" % port, "--stats", clientStats] + windowArgs,
+                                stdin=subprocess.DEVNULL, stdout=logs, stderr=logs, timeout=limit)
+        exitCode = client.returncode
+    except subprocess.TimeoutExpired:
+        exitCode = None
+    elapsed = time.time() - start
+    c = readSummary(clientStats, 0.0)
+    s = readSummary(join(tmpDir, "server-*.json"), 2.0)    # written once the last ACK reaches the server
+    for proc in procs:
+        proc.terminate()
+        proc.wait()
+    logs.close()
+
+    ok = exitCode == 0 and exists(received)
+    if exists(received):
+        with open(received, 'rb') as f:
+            ok = ok and f.read() == data
+        remove(received)
+    return {'impl': impl, 'profile': profile, 'size': len(data), 'seed': seed, 'ok': ok,
+            'seconds': c.get('duration') or elapsed, 'goodput': c.get('goodput', 0.0),
+            'rtt_avg': s.get('rtt_avg'), 'retransmits': s.get('retransmits'), 'timeouts': s.get('timeouts')}
+
+def summarize(rows):
+    """ one line per (impl, profile, size): success rate and the means over the successful runs """
+    print("%-9s %-7s %9s %5s %9s %11s %9s %9s" % ('impl', 'profile', 'size', 'ok', 'seconds', 'goodput', 'rtt avg', 'retrans'))
+    for key in sorted(set((r['impl'], r['profile'], r['size']) for r in rows)):
+        runs = [r for r in rows if (r['impl'], r['profile'], r['size']) == key]
+        good = [r for r in runs if r['ok']]
+        avg = lambda field: mean(r[field] for r in good if r[field] is not None) if any(r[field] is not None for r in good) else float('nan')
+        print("%-9s %-7s %9d %2d/%-2d %8.2fs %8.0fB/s %7.1fms %9.1f" %
+              (key + (len(good), len(runs), avg('seconds'), avg('goodput'), avg('rtt_avg') * 1000, avg('retransmits'))))
+
+def names(text):
+    return text.split(",")
+
+def ints(text):
+    return [int(v) for v in text.split(",")]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the programs through the p1/p2/p3 proxy profiles and tabulate their performance")
+    parser.add_argument('--impl', type=names, default=["stopWait", "sliding"], help='implementations, comma separated')
+    parser.add_argument('--profiles', type=names, default=["p1", "p2", "p3"], help='proxy scripts in this directory, comma separated')
+    parser.add_argument('--sizes', type=ints, default=[10000, 100000], help='test file sizes in bytes, comma separated')
+    parser.add_argument('--runs', type=int, default=3, help='runs of every combination, seeded --seed, --seed+1, ...')
+    parser.add_argument('--seed', type=int, default=1, help='proxy seed of the first run')
+    parser.add_argument('--window', type=int, default=10, help='window of the sliding programs')
+    parser.add_argument('--port', type=int, default=50100, help='proxy client port, the server listens on the next one')
+    parser.add_argument('--limit', type=float, default=600.0, help='seconds before a transfer is counted as failed')
+    parser.add_argument('--csv', default=None, help='also write every run to this CSV file')
+    args = parser.parse_args()
+
+    rows = []
+    with TemporaryDirectory() as tmpDir:
+        for size in args.sizes:
+            data = Random(size).randbytes(size)
+            fileName = "bench-%d.bin" % size
+            for impl in args.impl:
+                served = join(repoDir, impl, "server", fileName)    # the servers serve their own directory
+                with open(served, 'wb') as f:
+                    f.write(data)
+                try:
+                    for profile in args.profiles:
+                        for run in range(args.runs):
+                            row = runOnce(impl, profile, fileName, data, args.seed + run, args.port, args.window, args.limit, tmpDir)
+                            print("%(impl)s %(profile)s size=%(size)d seed=%(seed)d ok=%(ok)s %(seconds).2fs %(goodput).0fB/s" % row)
+                            sys.stdout.flush()
+                            rows.append(row)
+                finally:
+                    remove(served)
+
+    print()
+    summarize(rows)
+    if args.csv is not None:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
@@ -4,7 +4,8 @@
 
 import sys, re
 import time, random
-import queue
+import heapq, itertools, csv
+from collections import deque
 from select import select
 from socket import *
 from sys import exit
@@ -25,6 +26,12 @@ def usage():
          [--pDrop <prob-drop-msg]                      0.0     Probability of message being dropped
          [--pDup <prob-dup-msg]                        0.0     Probability of a msg duplication 
 
+         [--links shared|perClient]                 shared     All clients share one bottleneck, or each gets its own
+         [--flowIdle <sec>]                            60.0     Forget a client after this long without traffic
+         [--seed <int>]                                none     Seed drops, delays and duplicates, for repeatable runs
+         [--trace <file.csv>]                                   Log every packet's arrival, fate and delivery
+         [--replay <file.csv>]                                  Apply the drops, delays and duplicates of a trace
+
          [--verbose]                                    off    Verbose Mode
          [--help]                                              This help screen""" % sys.argv[0])
     sys.exit(1)
@@ -47,91 +54,126 @@ delayMax = 1.0                          # max delay
 qCap = 4                                # queue capacity
 pDrop = 0.0                             # drop probability
 pDup = 0.0                              # duplicate probability
+links = "shared"                        # "shared" bottleneck, or independent "perClient" links
+flowIdle = 60.0                         # seconds before an idle client's flow is closed
+seed = None                             # random seed, None seeds from the OS
+tracePath = None                        # CSV file every packet event is logged to
+replayPath = None                       # trace whose drop/delay/dup decisions are replayed
 verbose = 0                             # verbose mode
 
-try:
-    args = sys.argv[1:]
-    while args:
-        sw = args[0]; del args[0]
-        if sw == "--clientPort":
-            toClientAddr = ("", int(args[0])); del args[0]
-        elif sw == "--serverAddr":
-            addr, port = re.split(":", args[0]); del args[0]
-            serverAddr = (addr, int(port))
-        elif sw == "--byteRate":
-            byteRate = float(args[0]); del args[0]
-        elif sw == "--propLat":
-            propLat = float(args[0]); del args[0]
-        elif sw == "--pDelay":
-            print("pdelay!", args[0])
-            pDelay = float(args[0]); del args[0]
-        elif sw == "--delayMin":
-            delayMin = float(args[0]); del args[0]
-            if delayMin > delayMax:
-                delayMax = delayMin
-        elif sw == "--delayMax":
-            delayMax = float(args[0]); del args[0]
-        elif sw == "--qCap":
-            qCap = int(args[0]); del args[0]
-        elif sw == "--pDrop":
-            pDrop = float(args[0]); del args[0]
-        elif sw == "--pDup":
-            pDup = float(args[0]); del args[0]
-        elif sw == "-v" or sw == "--verbose":
-            verbose = 1
-        elif sw == "-h" or sw == "--help":
-            usage();
-        else:
-            print("unexpected parameter %s" % sw)
-            usage();
-except Exception as e:
-    print("Error parsing arguments %s" % (e))
-    usage()
-
-#print parameters
-print("argv=", sys.argv)
-print("""Parameters: \nclientAddr=%s, serverAddr=%s, byteRate=%g, propLat=%g,
-        pDelay=%f, delayMin=%d, delayMax=%d, qCap=%d, pDrop=%g, pDup=%g, verbose=%d""" % \
-      (repr(toClientAddr), repr(serverAddr), byteRate, propLat, pDelay, delayMin, delayMax, qCap, pDrop, pDup, verbose))
-
-# setup up connections
-toServerSocket = socket(AF_INET, SOCK_DGRAM)  # outgoing socket
-
-toClientSocket = socket(AF_INET, SOCK_DGRAM)  # incoming socket
-toClientSocket.bind(toClientAddr)             # bind so we can listen on incoming port
-
-# pair and name sockets
-otherSocket = {toClientSocket:toServerSocket, toServerSocket:toClientSocket}
-sockName = {toClientSocket:"toClientSocket", toServerSocket:"toServerSocket"}
-
-# ready data structures
-timeActions = queue.PriorityQueue()           # minheap of (when, action).   <Action>() should be called at time <when>.
-
-###################### Initialization complete ##############################
+###################### Link model ##############################
+
+class EventQueue:
+    """ minheap of (when, seq, action).   <Action>() should be called at time <when>.
+        seq orders actions due at the same time by insertion, so actions are never compared """
+    def __init__(self):
+        self.heap = []
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def put(self, when, action):
+        heapq.heappush(self.heap, (when, next(self.seq), action))
+
+    def peek(self):
+        """ time of the earliest action, without removing it """
+        return self.heap[0][0]
+
+    def pop(self):
+        """ remove and return the earliest (when, action) """
+        when, seq, action = heapq.heappop(self.heap)
+        return when, action
+
+
+class PacketTrace:
+    """ CSV log of every packet event on every link: time, link, seq, copy, event, value.
+        seq numbers the messages arriving at a link, copy is 1 for the duplicate of a message.
+        Events are arrive (length), then the random decisions drop, delay (seconds added) and
+        dup (a copy follows), then full (dropped, queue full) or enqueue (end of transmission),
+        and deliver.  The decisions are drawn and logged even for a message that finds the
+        queue full, so a replay can apply them to a build whose queue behaves differently """
+    def __init__(self, path):
+        self.file = open(path, "w", newline="", buffering=1)   # line buffered, so a killed proxy keeps its trace
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(("time", "link", "seq", "copy", "event", "value"))
+
+    def record(self, when, link, seq, copy, event, value=""):
+        self.writer.writerow(("%.6f" % relTime(when), link, seq, copy, event, value))
+
+    def close(self):
+        self.file.close()
+
+def loadFates(path):
+    """ the random decisions of a trace: link -> {(seq, copy): (drop, delay, dup)} """
+    fates = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            link = fates.setdefault(row["link"], {})
+            key = (int(row["seq"]), int(row["copy"]))
+            drop, delay, dup = link.get(key, (False, 0.0, False))
+            if row["event"] == "drop":
+                drop = True
+            elif row["event"] == "delay":
+                delay = float(row["value"])
+            elif row["event"] == "dup":
+                dup = True
+            elif row["event"] != "arrive":
+                continue
+            link[key] = (drop, delay, dup)
+    return fates
 
 class TransmissionSim:
-    def __init__(self, outSock, destAddr, byteRate, propLat, pDelay, delayMin, delayMax, qCap, pDrop, pDup):
-        self.outSock, self.destAddr, self.byteRate, self.propLat =  \
-         outSock, destAddr, 1.0*byteRate, propLat
+    """ one direction of a link: a transmit queue of qCap messages drained at byteRate,
+        followed by propLat and random drops, delays and duplicates.
+        clock() returns the current time, wall-clock by default or virtual time in udpSim.py.
+        rng draws the same number of values for every arriving message, so with a seeded rng the
+        fate of the n-th message does not depend on timing.  fates, from loadFates(), replays
+        the decisions of a trace instead; messages beyond the end of the trace fall back to rng """
+    def __init__(self, name, byteRate, propLat, pDelay, delayMin, delayMax, qCap, pDrop, pDup,
+                 clock=time.time, rng=random, trace=None, fates=None):
+        self.name, self.byteRate, self.propLat, self.clock =  \
+         name, 1.0*byteRate, propLat, clock
         self.pDelay, self.delayMin, self.delayMax, self.qCap, self.pDrop, self.pDup = \
          pDelay, delayMin, delayMax, qCap, pDrop, pDup
-        self.busyUntil = time.time()
-        self.xmitCompTimes = []
-
-    def scheduleDelivery(self, msg, eventQueue, duplicateMessage):
-        """ returns a list of delivery times for a message"""
-        deliveryTimes = {}
-        now = time.time()
+        self.rng, self.trace, self.fates = rng, trace, fates or {}
+        self.busyUntil = clock()
+        self.xmitCompTimes = deque()   # completion times of queued messages, oldest first
+        self.arrivals = 0               # seq of the next message
+
+    def fate(self, seq, copy):
+        """ (drop, delay, dup) of a message """
+        r = [self.rng.random() for i in range(4)]
+        if (seq, copy) in self.fates:
+            return self.fates[seq, copy]
+        delay = self.delayMin + r[2] * (self.delayMax - self.delayMin) if self.pDelay > r[1] else 0
+        return self.pDrop > r[0], delay, not copy and self.pDup > r[3]
+
+    def record(self, when, seq, copy, event, value=""):
+        if self.trace:
+            self.trace.record(when, self.name, seq, copy, event, value)
+
+    def scheduleDelivery(self, msg, outSock, destAddr, eventQueue, duplicateMessage, seq=None):
+        """ schedule msg to be sent from outSock to destAddr when it would have crossed the link """
+        now = self.clock()
         if verbose:
-            global sockName
-            print("msg for %s rec'd at %f seconds" % (sockName[self.outSock], relTime(now)))
+            print("msg for %s rec'd at %f seconds" % (self.name, relTime(now)))
+        if seq is None:
+            seq = self.arrivals; self.arrivals += 1
+        copy = 1 if duplicateMessage else 0
+        self.record(now, seq, copy, "arrive", len(msg))
+        drop, delay, dup = self.fate(seq, copy)
+        if drop: self.record(now, seq, copy, "drop")
+        if delay: self.record(now, seq, copy, "delay", "%.6f" % delay)
+        if dup: self.record(now, seq, copy, "dup")
 
         length = len(msg)
         q = self.xmitCompTimes  # flush messages transmitted in the past
-        while len(q) and q[0] < now:
-            del q[0]
+        while q and q[0] < now:
+            q.popleft()
         if len(q) >= self.qCap: # drop if q full
             if verbose: print("... queue full (oldest relTime = %f).  :(" % relTime(q[0]))
+            self.record(now, seq, copy, "full")
             return
 
         # we really don't throttle (bytes/second) so a message is sent as a burst
@@ -146,69 +188,183 @@ class TransmissionSim:
             print("... will be transmitted at reltime %f" % relTime(endTransmissionTime))
    
         q.append(endTransmissionTime) # in transmit q until transmitted
-        self.busyUntil = min(self.busyUntil, endTransmissionTime) # earliest time for next msg
+        self.busyUntil = endTransmissionTime # earliest time for next msg
+        self.record(now, seq, copy, "enqueue", "%.6f" % relTime(endTransmissionTime))
 
         deliveryTime = endTransmissionTime + self.propLat
 
         # check for drops
-        if self.pDrop > random.random(): # random drops
+        if drop: # random drops
             if verbose: print("... random drop ;)")
             return
 
         # add delay
-        delay = 0
-        if self.pDelay > random.random():
-            delay = self.delayMin + random.random() * (self.delayMax - self.delayMin)
+        if delay:
             if verbose: print(".. delaying %fs" % (delay))
         deliveryTime += delay
 
         if verbose: print("... scheduled for delivery at relTime %f" % relTime(deliveryTime))
 
         # check if we duplicate message
-        if duplicateMessage is False and self.pDup > random.random():
+        if dup:
             if verbose: print("Duplicating message ...")
-            self.scheduleDelivery(msg, eventQueue, True) 
+            self.scheduleDelivery(msg, outSock, destAddr, eventQueue, True, seq) 
 
         if verbose: print("Message enqueued ... \n\n")    
-        eventQueue.put((deliveryTime, lambda : TransmissionSim.deliver(self, msg)))
-
-    def setDest(self, destAddr):
-        """ update destination address """
-        self.destAddr = destAddr
-
-    def deliver(self, msg):
-        """ deliver a message to the existing destination """
-        if verbose: print("sending <%s> to %s at relTime=%f" % (msg, repr(self.destAddr), relTime(time.time())))
-        self.outSock.sendto(msg, self.destAddr)
-
-transmissionSims = {}                   # inSock -> simulatorForOutSock
-for inSock, outAddr in ((toClientSocket, serverAddr), (toServerSocket, ("", None))): # client's addr will be set when msg rec'd
-    # send to other sock!
-    transmissionSims[inSock] = TransmissionSim(otherSocket[inSock],
-                                               outAddr, byteRate, propLat, pDelay, delayMin, delayMax, qCap, pDrop, pDup) 
-
-rSet = set([toClientSocket, toServerSocket])
-wSet = set()
-xSet = set([toClientSocket, toServerSocket])
-
-while True:                             # forever
-    now = time.time()
-    sleepUntil = now+1.0                # default, 1s from now
-    while not timeActions.empty():      # deal with all actions in the past
-        when, action = timeActions.get() 
-        if when > now:                  # if when in the future
-            sleepUntil = min(sleepUntil, when) #   awaken no later than when
-            timeActions.put((when, action)) # and put back in heap
-            break;                          # done with scheduled events thus far
-        action()                        # otherwise, when is in the past, therefore perform the action
-    rReady, wReady, xReady = select(rSet, wSet, xSet, sleepUntil - now) # select uses relative time
-    for sock in rReady:
-        msg,addr = sock.recvfrom(2048)
-        if sock == toClientSocket:      # if from client, update dest of toServer's transmission simulator 
-            transmissionSims[toServerSocket].setDest(addr)
-        transmissionSims[sock].scheduleDelivery(msg, timeActions, False)
+        eventQueue.put(deliveryTime, lambda : TransmissionSim.deliver(self, msg, outSock, destAddr, seq, copy))
+
+    def deliver(self, msg, outSock, destAddr, seq=None, copy=0):
+        """ deliver a message to its destination """
+        if verbose: print("sending <%s> to %s at relTime=%f" % (msg, repr(destAddr), relTime(self.clock())))
+        self.record(self.clock(), seq, copy, "deliver")
+        try:
+            outSock.sendto(msg, destAddr)
+        except OSError as e:            # the flow was closed while msg was in flight
+            if verbose: print("... not delivered: %s" % e)
+
+def newLinkPair(name):
+    """ simulators for the (toServer, toClient) directions of a link.
+        Each draws from its own generator, seeded from --seed and its name """
+    pair = []
+    for direction in ("toServer", "toClient"):
+        linkName = "%s %s" % (direction, name)
+        rng = random.Random(None if seed is None else "%d %s" % (seed, linkName))
+        pair.append(TransmissionSim(linkName, byteRate, propLat, pDelay, delayMin, delayMax, qCap, pDrop, pDup,
+                                    rng=rng, trace=trace, fates=fates.get(linkName)))
+    return tuple(pair)
+
+class Flow:
+    """ a client seen by the proxy: its own socket toward the server and the link its messages cross.
+        Per-client links are named by the order clients appeared in, so a trace replays across runs """
+    count = 0
+
+    def __init__(self, clientAddr):
+        self.clientAddr = clientAddr
+        self.toServerSocket = socket(AF_INET, SOCK_DGRAM)
+        self.toServer, self.toClient = sharedLink or newLinkPair("client %d" % Flow.count)
+        Flow.count += 1
+        self.lastHeard = time.time()
+
+    def close(self):
+        self.toServerSocket.close()
+
+if __name__ == '__main__':
+    try:
+        args = sys.argv[1:]
+        while args:
+            sw = args[0]; del args[0]
+            if sw == "--clientPort":
+                toClientAddr = ("", int(args[0])); del args[0]
+            elif sw == "--serverAddr":
+                addr, port = re.split(":", args[0]); del args[0]
+                serverAddr = (addr, int(port))
+            elif sw == "--byteRate":
+                byteRate = float(args[0]); del args[0]
+            elif sw == "--propLat":
+                propLat = float(args[0]); del args[0]
+            elif sw == "--pDelay":
+                print("pdelay!", args[0])
+                pDelay = float(args[0]); del args[0]
+            elif sw == "--delayMin":
+                delayMin = float(args[0]); del args[0]
+                if delayMin > delayMax:
+                    delayMax = delayMin
+            elif sw == "--delayMax":
+                delayMax = float(args[0]); del args[0]
+            elif sw == "--qCap":
+                qCap = int(args[0]); del args[0]
+            elif sw == "--pDrop":
+                pDrop = float(args[0]); del args[0]
+            elif sw == "--pDup":
+                pDup = float(args[0]); del args[0]
+            elif sw == "--links":
+                links = args[0]; del args[0]
+                if links not in ("shared", "perClient"):
+                    raise ValueError("--links must be shared or perClient")
+            elif sw == "--flowIdle":
+                flowIdle = float(args[0]); del args[0]
+            elif sw == "--seed":
+                seed = int(args[0]); del args[0]
+            elif sw == "--trace":
+                tracePath = args[0]; del args[0]
+            elif sw == "--replay":
+                replayPath = args[0]; del args[0]
+            elif sw == "-v" or sw == "--verbose":
+                verbose = 1
+            elif sw == "-h" or sw == "--help":
+                usage();
+            else:
+                print("unexpected parameter %s" % sw)
+                usage();
+    except Exception as e:
+        print("Error parsing arguments %s" % (e))
+        usage()
+
+    #print parameters
+    print("argv=", sys.argv)
+    print("""Parameters: \nclientAddr=%s, serverAddr=%s, byteRate=%g, propLat=%g,
+        pDelay=%f, delayMin=%d, delayMax=%d, qCap=%d, pDrop=%g, pDup=%g, links=%s, flowIdle=%g, seed=%s, trace=%s, replay=%s, verbose=%d""" % \
+          (repr(toClientAddr), repr(serverAddr), byteRate, propLat, pDelay, delayMin, delayMax, qCap, pDrop, pDup, links, flowIdle,
+           seed, tracePath, replayPath, verbose))
+    trace = PacketTrace(tracePath) if tracePath else None
+    fates = loadFates(replayPath) if replayPath else {}
+
+    # setup up connections
+    toClientSocket = socket(AF_INET, SOCK_DGRAM)  # incoming socket
+    toClientSocket.bind(toClientAddr)             # bind so we can listen on incoming port
+    # each client gets its own outgoing socket (see Flow), so the server sees one address per client
+
+    ###################### Initialization complete ##############################
+
+    # ready data structures
+    timeActions = EventQueue()
+    sharedLink = newLinkPair("shared") if links == "shared" else None
+
+    flows = {}                              # clientAddr -> Flow
+    flowBySock = {}                         # flow's toServerSocket -> Flow
+
+    nextReap = time.time()                  # next time idle flows are looked for
+    rSet = set([toClientSocket])
+    wSet = set()
+    xSet = set([toClientSocket])
+
+    while True:                             # forever
+        now = time.time()
+        sleepUntil = now+1.0                # default, 1s from now
+        while timeActions:                  # deal with all actions in the past
+            when = timeActions.peek()
+            if when > now:                  # if when in the future
+                sleepUntil = min(sleepUntil, when) #   awaken no later than when
+                break;                          # done with scheduled events thus far
+            timeActions.pop()[1]()          # otherwise, when is in the past, therefore perform the action
+        rReady, wReady, xReady = select(rSet, wSet, xSet, sleepUntil - now) # select uses relative time
+        now = time.time()
+        for sock in rReady:
+            msg,addr = sock.recvfrom(2048)
+            if sock == toClientSocket:      # from a client, forward from its flow's socket to the server
+                flow = flows.get(addr)
+                if flow is None:
+                    flow = flows[addr] = Flow(addr)
+                    flowBySock[flow.toServerSocket] = flow
+                    rSet.add(flow.toServerSocket); xSet.add(flow.toServerSocket)
+                    if verbose: print("new flow for client %s" % repr(addr))
+                flow.lastHeard = now
+                flow.toServer.scheduleDelivery(msg, flow.toServerSocket, serverAddr, timeActions, False)
+            else:                           # from the server, forward to the client that owns this socket
+                flow = flowBySock[sock]
+                flow.lastHeard = now
+                flow.toClient.scheduleDelivery(msg, toClientSocket, flow.clientAddr, timeActions, False)
+
+        if now >= nextReap:                 # forget clients that went quiet, about once a second
+            nextReap = now + 1.0
+            for addr, flow in list(flows.items()):
+                if now - flow.lastHeard > flowIdle:
+                    if verbose: print("closing idle flow for client %s" % repr(addr))
+                    del flows[addr], flowBySock[flow.toServerSocket]
+                    rSet.discard(flow.toServerSocket); xSet.discard(flow.toServerSocket)
+                    flow.close()
          
-    for sock in xReady:
-        print("weird.  UDP socket reported an error.  Bye.")
-        sys.exit(1)
+        for sock in xReady:
+            print("weird.  UDP socket reported an error.  Bye.")
+            sys.exit(1)
 
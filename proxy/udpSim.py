@@ -0,0 +1,217 @@
+#! /bin/python
+
+# Virtual-time simulation of the sliding window client and server talking through the udpProxy link model
+
+import argparse, io, itertools, random, sys, time
+from contextlib import redirect_stdout
+from importlib.util import module_from_spec, spec_from_file_location
+from os.path import abspath, basename, dirname, join, splitext
+from tempfile import TemporaryDirectory
+
+import udpProxy
+from udpProxy import EventQueue, PacketTrace, TransmissionSim, loadFates
+
+repoDir = join(dirname(abspath(__file__)), '..')
+
+def loadModule(name, *relPath):
+    """ import one of the protocol programs by path; they are scripts, not packages, and share file names """
+    spec = spec_from_file_location(name, join(repoDir, *relPath))
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+slidingServer = loadModule("slidingServer", "sliding", "server", "udpServer.py")
+slidingClient = loadModule("slidingClient", "sliding", "client", "udpClient.py")
+
+PROXY = ("proxy", 50000)                # the proxy's client port, where clients send
+SERVER = ("server", 50001)
+
+class VirtualClock:
+    """ time that only advances when the simulation jumps to the next event """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class SimNetwork:
+    """ hosts by address, and the link simulator each (sender, destination) pair sends through """
+    def __init__(self, clock, events):
+        self.clock, self.events = clock, events
+        self.hosts = {}                 # addr -> handle(msg, fromAddr, now)
+        self.routes = {}                # (fromAddr, toAddr) -> (TransmissionSim, port delivering from, addr delivered to)
+
+    def send(self, fromAddr, msg, toAddr):
+        route = self.routes.get((fromAddr, toAddr))
+        if route is not None:           # the proxy drops datagrams it has no flow for
+            link, port, destAddr = route
+            link.scheduleDelivery(msg, port, destAddr, self.events, False)
+
+class SimSocket:
+    """ stands in for the UDP socket of a protocol engine """
+    def __init__(self, network, addr):
+        self.network, self.addr = network, addr
+
+    def sendto(self, msg, toAddr):
+        self.network.send(self.addr, bytes(msg), toAddr)
+
+class SimPort:
+    """ stands in for a proxy socket: TransmissionSim.deliver sends through it at delivery time """
+    def __init__(self, network, addr):
+        self.network, self.addr = network, addr
+
+    def sendto(self, msg, toAddr):
+        self.network.hosts[toAddr](msg, self.addr, self.network.clock())
+
+class SimServer(slidingServer.Server):
+    """ sliding window server that keeps the statistics of the sessions it closes """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.closedStats = {}           # client address -> TransferStats
+
+    def close_session(self, addr, now, outcome):
+        self.closedStats[addr] = self.sessions[addr].stats
+        super().close_session(addr, now, outcome)
+
+    def statsOf(self, addr):
+        """ statistics of the session of a client, open or closed """
+        session = self.sessions.get(addr)
+        return session.stats if session is not None else self.closedStats.get(addr)
+
+class SimClient:
+    """ sliding window download into memory, remembering when it is over """
+    def __init__(self, network, addr, fileName, window, timeout, maxTries):
+        self.addr = addr
+        self.out = io.BytesIO()
+        self.stats = slidingClient.TransferStats()
+        self.download = slidingClient.Download(SimSocket(network, addr), PROXY, basename(fileName), self.out,
+                                               window, timeout, maxTries, self.stats)
+        self.finished = False
+
+    def handle(self, msg, addr, now):
+        if not self.finished:
+            self.finished = self.download.handle(msg, addr, now)
+
+    def onTimeout(self, now):
+        if not self.finished and self.download.next_deadline() <= now:
+            self.finished = self.download.on_timeout(now)
+
+def simulate(fileName, clients, window, timeout, maxTries, link, sharedLink, limit, seed, trace=None, fates={}, pace=False, rate=None, fec=None):
+    """ transfer fileName to that many clients at once, returns the server and the list of SimClients.
+        Links are named as udpProxy.py names them, so traces of either can be replayed by the other """
+    clock = VirtualClock()
+    events = EventQueue()
+    network = SimNetwork(clock, events)
+    def newLinkPair(name):
+        return tuple(TransmissionSim(linkName, clock=clock, rng=random.Random("%d %s" % (seed, linkName)),
+                                     trace=trace, fates=fates.get(linkName), **link)
+                     for linkName in ("%s %s" % (direction, name) for direction in ("toServer", "toClient")))
+    shared = newLinkPair("shared") if sharedLink else None
+
+    server = SimServer(SimSocket(network, SERVER), dirname(fileName), window, timeout, maxTries, None, pace, rate, fec)
+    network.hosts[SERVER] = server.handle
+    proxyPort = SimPort(network, PROXY)
+
+    simClients = []
+    for i in range(clients):
+        clientAddr, flowAddr = ("client", i), ("proxy", 40000 + i)   # flowAddr is the proxy's socket for this client
+        toServer, toClient = shared or newLinkPair("client %d" % i)
+        network.routes[clientAddr, PROXY] = (toServer, SimPort(network, flowAddr), SERVER)
+        network.routes[SERVER, flowAddr] = (toClient, proxyPort, clientAddr)
+        client = SimClient(network, clientAddr, fileName, window, timeout, maxTries)
+        network.hosts[clientAddr] = client.handle
+        simClients.append(client)
+        client.download.request(clock.now)
+
+    while clock.now < limit:
+        active = [c for c in simClients if not c.finished]
+        if not active:
+            break
+        deadlines = [c.download.next_deadline() for c in active] + [server.next_deadline()]
+        if events:
+            deadlines.append(events.peek())
+        clock.now = max(clock.now, min(d for d in deadlines if d is not None))   # jump to the next event
+        while events and events.peek() <= clock.now:
+            events.pop()[1]()
+        server.on_timeout(clock.now)
+        for c in active:
+            c.onTimeout(clock.now)
+
+    for c in simClients:
+        if c.download.error is not None or not c.finished:
+            c.stats.mark(clock.now, 'aborted')
+    return server, simClients
+
+def floats(text):
+    return [float(v) for v in text.split(",")]
+
+def ints(text):
+    return [int(v) for v in text.split(",")]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate sliding window transfers through the proxy link model in virtual time")
+    parser.add_argument('--file', default=None, help='file to transfer (default: --size random bytes)')
+    parser.add_argument('--size', type=int, default=100000, help='bytes of the generated file')
+    parser.add_argument('--clients', type=int, default=1, help='clients downloading the file at the same time')
+    parser.add_argument('--window', type=ints, default=[10], help='window sizes to sweep, comma separated')
+    parser.add_argument('--timeout', type=floats, default=[1.0], help='initial timeouts to sweep, comma separated')
+    parser.add_argument('--maxtries', type=int, default=5, help='timeouts in a row before a side gives up')
+    parser.add_argument('--runs', type=int, default=1, help='runs per combination, seeded --seed, --seed+1, ...')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the first run')
+    parser.add_argument('--limit', type=float, default=3600.0, help='virtual seconds before a run is abandoned')
+    parser.add_argument('--byteRate', type=float, default=10000, help='bytes/second of each link')
+    parser.add_argument('--propLat', type=float, default=0.05, help='propagation latency in seconds')
+    parser.add_argument('--qCap', type=int, default=3, help='messages each link can queue')
+    parser.add_argument('--pDelay', type=float, default=0.0, help='probability a message is delayed')
+    parser.add_argument('--delayMin', type=float, default=1.0, help='shortest extra delay')
+    parser.add_argument('--delayMax', type=float, default=1.0, help='longest extra delay')
+    parser.add_argument('--pDrop', type=float, default=0.0, help='probability a message is dropped')
+    parser.add_argument('--pDup', type=float, default=0.0, help='probability a message is duplicated')
+    parser.add_argument('--links', choices=("shared", "perClient"), default="shared", help='one bottleneck for every client, or one link each')
+    parser.add_argument('--pace', action='store_true', help='pace the server at the packet pair estimate of the bottleneck rate')
+    parser.add_argument('--rate', type=float, default=None, help='pace the server at this many bytes/second [implies --pace]')
+    parser.add_argument('--fec', type=slidingServer.fec_group, default=None, help='send a parity block after every group of K blocks, or auto')
+    parser.add_argument('--trace', default=None, help='log every packet event to this CSV file, with the run appended to the name when there are several')
+    parser.add_argument('--replay', default=None, help='apply the drops, delays and duplicates of this trace, from udpProxy.py or udpSim.py')
+    parser.add_argument('--verbose', action='store_true', help='print every link event and the programs\' own output')
+    args = parser.parse_args()
+
+    link = dict(byteRate=args.byteRate, propLat=args.propLat, pDelay=args.pDelay, delayMin=args.delayMin,
+                delayMax=args.delayMax, qCap=args.qCap, pDrop=args.pDrop, pDup=args.pDup)
+    udpProxy.verbose, udpProxy.startTime = int(args.verbose), 0.0   # relTime() of virtual time
+    fates = loadFates(args.replay) if args.replay else {}
+
+    with TemporaryDirectory() as tmpDir:
+        fileName = args.file
+        if fileName is None:            # the server serves the directory the file is in
+            fileName = join(tmpDir, "sim-%d.bin" % args.size)
+            with open(fileName, 'wb') as f:
+                f.write(random.Random(args.size).randbytes(args.size))
+        with open(fileName, 'rb') as f:
+            expected = f.read()
+
+        print("%6s %7s %4s %6s %5s %9s %10s %8s %7s %8s %8s" %
+              ('window', 'timeout', 'run', 'client', 'ok', 'seconds', 'goodput', 'retrans', 'tmouts', 'rtt avg', 'cpu'))
+        for window, timeout in itertools.product(args.window, args.timeout):
+            for run in range(args.runs):
+                trace = None
+                if args.trace is not None:
+                    single = len(args.window) == len(args.timeout) == args.runs == 1
+                    root, ext = splitext(args.trace)
+                    trace = PacketTrace(args.trace if single else "%s-w%d-t%g-r%d%s" % (root, window, timeout, run, ext))
+                cpuStart = time.process_time()
+                with redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+                    server, simClients = simulate(fileName, args.clients, window, timeout, args.maxtries, link,
+                                                  args.links == "shared", args.limit, args.seed + run, trace, fates,
+                                                  args.pace, args.rate, args.fec)
+                cpu = time.process_time() - cpuStart
+                if trace is not None:
+                    trace.close()
+                for i, c in enumerate(simClients):
+                    s = c.stats.summary()           # goodput as seen by the client
+                    serverStats = server.statsOf(("proxy", 40000 + i))    # retransmissions and RTT as seen by the server
+                    ss = serverStats.summary() if serverStats else {'retransmits': 0, 'timeouts': 0, 'rtt_avg': None}
+                    print("%6d %7.2f %4d %6d %5s %8.2fs %8.0fB/s %8d %7d %6.1fms %7.3fs" %
+                          (window, timeout, run, i, c.download.error is None and c.out.getvalue() == expected,
+                           s['duration'], s['goodput'], ss['retransmits'], ss['timeouts'], (ss['rtt_avg'] or 0) * 1000, cpu))
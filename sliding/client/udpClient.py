@@ -0,0 +1,403 @@
+import argparse
+from enum import Enum
+from io import BytesIO
+from multiprocessing import Pool
+import os
+from os.path import abspath, dirname, exists, join
+from select import select
+from socket import socket, AF_INET, SOCK_DGRAM
+from sys import exit, path
+from time import time
+import zlib
+
+path.insert(0, join(dirname(abspath(__file__)), '..', '..'))
+from common.aio import run_download
+from common.batch import BatchWriter, encode_manifest, pack_manifests
+from common.checkpoint import Checkpoint
+from common.delta import (RangeWriter, byte_ranges, changed_ranges, encode_ranges, fit_ranges, parse_signature,
+                          signature)
+from common.fec import ParityDecoder
+from common.protocol import (ACK_RECOVERED, BLOCK_SIZE, MsgType, check_request, encode_msg, decode_msg, encode_bitmap, encode_request,
+                             encode_sack, msg_flags)
+from common.reassembly import BlockWriter
+from common.rtt import RttEstimator
+from common.stats import TransferStats
+
+# Enum class used to specify each state the client can be in
+class State(Enum):
+    READY = 0
+    WAITING = 1
+    EXITING = 2
+
+# Class that receives one file into f, a BlockWriter that puts every block in place as it arrives, or any
+# writable stream, which gets the blocks in order while those that arrive ahead of the next one are buffered
+# [raises ValueError when the name and options do not fit into a REQUEST]
+class Download:
+    def __init__(self, sock, server_addr, filename, f, window, timeout, max_tries, stats, checkpoint=None, options={}):
+        self.sock, self.server_addr, self.filename, self.f, self.stats = sock, server_addr, filename, f, stats
+        self.window, self.max_tries, self.checkpoint = window, max_tries, checkpoint
+        self.options = options  # REQUEST options, see common/protocol.py
+        self.payload = check_request(encode_request(filename, **options))
+        self.inflater = zlib.decompressobj() if options.get('z') else None
+        self.rtt = RttEstimator(timeout)
+        self.state = State.READY
+        self.held = checkpoint.held if checkpoint else 0    # blocks a previous attempt already wrote
+        self.expected = self.held + 1   # next block to be written to the file
+        self.last_block = None  # known once the block flagged as last arrives
+        self.highest = self.held    # highest block received, the blocks missing below it were NACKed
+        self.positional = isinstance(f, BlockWriter)
+        self.buffered = {}      # block -> payload of blocks received out of order, None once a BlockWriter has it
+        self.parity = ParityDecoder()   # rebuilds a block lost from a group the server sent a PARITY of
+        self.tries = 0
+        self.sent_at = None
+        self.deadline = None
+        self.error = None
+
+    def request(self, now):
+        if self.tries == 0:
+            self.stats.mark(now, 'request')
+        msg = encode_msg(False, MsgType.REQUEST, self.held, self.payload)    # the server resumes after block held
+        self.sock.sendto(msg, self.server_addr)
+        self.stats.sent(now, 0, len(msg), retransmit=self.tries > 0)
+        self.sent_at = now if self.tries == 0 else None     # Karn's rule: a repeated REQUEST is not timed
+        self.deadline = now + self.rtt.rto
+
+    def done(self):
+        return self.last_block is not None and self.expected > self.last_block
+
+    # Method to write the next block to the file, expanding it first when the transfer is compressed
+    def write(self, block, payload):
+        if self.inflater:
+            payload = self.inflater.decompress(payload)
+            if block == self.last_block:
+                payload += self.inflater.flush()
+            self.stats.expanded(len(payload))
+        self.f.write(payload)
+
+    # Method to count the whole blocks of the file in the output, where a resumed download starts
+    def held_on_disk(self):
+        return self.f.prefix if self.positional else self.f.tell() // BLOCK_SIZE
+
+    # Method to take a block received for the first time, writing out the in-order prefix it completes
+    def accept(self, block, payload, is_last_block):
+        if self.positional:
+            self.f.add(block, payload, is_last_block)
+        self.buffered[block] = None if self.positional else payload
+        self.parity.add_block(block, payload)
+        self.stats.delivered(len(payload))
+        if is_last_block:
+            self.last_block = block
+        while self.expected in self.buffered:   # write out the in-order prefix
+            payload = self.buffered.pop(self.expected)
+            if payload is not None:
+                self.write(self.expected, payload)
+            self.expected += 1
+            self.parity.forget(self.expected)
+        if self.checkpoint:
+            self.checkpoint.update(self.held_on_disk(), self.f)
+
+    # Method to acknowledge a block, with a SACK of every block held so far
+    def ack(self, block, addr, now, flags=0):
+        ack = encode_msg(False, MsgType.ACK, block, encode_sack(self.expected - 1, self.buffered), flags)
+        self.sock.sendto(ack, addr)
+        self.stats.sent(now, block, len(ack))
+        if self.done() and self.state != State.EXITING:
+            self.state = State.EXITING
+            self.stats.mark(now, 'done')
+
+    # Method to NACK the blocks that a block arriving beyond the highest one received shows to be missing,
+    # so each gap is reported once and a lost retransmission is left to the server's timer
+    def nack(self, block, addr, now):
+        missing = [b for b in range(max(self.expected, self.highest + 1), block) if b not in self.buffered]
+        self.highest = max(self.highest, block)
+        if not missing:
+            return
+        nack = encode_msg(False, MsgType.NACK, missing[0], encode_bitmap(missing[0], missing[1:]))
+        self.sock.sendto(nack, addr)
+        self.stats.sent(now, missing[0], len(nack))
+        self.stats.nack(now, missing[0])
+
+    # Method to rebuild every block the parities received so far allow, acknowledging each as recovered
+    def recover(self, addr, now):
+        rebuilt = self.parity.recover(self.expected, self.expected + self.window)
+        while rebuilt is not None:
+            block, payload = rebuilt
+            self.stats.recovered(now, block, True)
+            self.accept(block, payload, False)  # a group never holds the last block
+            self.ack(block, addr, now, ACK_RECOVERED)
+            rebuilt = self.parity.recover(self.expected, self.expected + self.window)
+
+    # Method to handle a message from the server, returns True once the transfer is over
+    def handle(self, msg, addr, now):
+        is_last_block, msgtype, block, payload = decode_msg(msg)
+        if msgtype == MsgType.DATA:
+            if self.state == State.READY:
+                self.stats.mark(now, 'transfer')
+                if self.sent_at is not None:
+                    self.rtt.sample(now - self.sent_at)
+                    self.stats.rtt(now, 0, now - self.sent_at)
+            self.rtt.reset_backoff()
+            self.server_addr = addr
+            if self.state != State.EXITING:     # duplicates during the linger period leave the transfer done
+                self.state = State.WAITING
+            self.tries = 0
+            self.deadline = now + self.rtt.rto
+            is_new = self.expected <= block < self.expected + self.window and block not in self.buffered
+            self.stats.received(now, block, len(msg), duplicate=not is_new)
+            if block >= self.expected + self.window:    # beyond the window, the server resends it later
+                return False
+            if is_new:
+                self.nack(block, addr, now)
+                self.accept(block, payload, is_last_block)
+            # blocks below the window are duplicates whose ACK was lost, so they are acknowledged again
+            self.ack(block, addr, now)
+            self.recover(addr, now)
+        elif msgtype == MsgType.PARITY:
+            self.stats.received(now, block, len(msg))
+            self.stats.parity(now, block)
+            self.parity.add_parity(block, 1 << msg_flags(msg), payload)
+            self.recover(addr, now)
+        elif msgtype == MsgType.ERROR:
+            self.error = payload.decode()
+            return True
+        return False
+
+    # Method to handle silence from the server, returns True when the client should stop
+    def on_timeout(self, now):
+        if self.state == State.EXITING:     # no retransmissions arrived during the linger period
+            return True
+        if self.tries == self.max_tries:
+            self.error = 'Error: maximum number of tries was reached'
+            return True
+        self.tries += 1
+        self.stats.timeout(now)
+        self.rtt.backoff()
+        if self.state == State.READY:
+            self.request(now)
+        else:
+            self.deadline = now + self.rtt.rto
+        return False
+
+    def next_deadline(self):
+        return self.deadline
+
+
+# Method to run a download until it is over, on the select loop or the asyncio one
+def run(download, engine='select'):
+    if engine == 'asyncio':
+        try:
+            run_download(download)
+        except KeyboardInterrupt:
+            if not download.done():
+                download.error = 'Error: interrupted'
+        return
+    sock = download.sock
+    # map socket to function to call when socket is....
+    read_sockfunc = {}      # ready for reading
+    write_sockfunc = {}     # ready for writing
+    error_sockfunc = {}     # broken
+
+    read_sockfunc[sock] = lambda sock: download.handle(*sock.recvfrom(100), time())
+
+    download.request(time())
+
+    running = True
+    try:
+        while running:
+            read_rdyset, write_rdyset, err_rdyset = select(list(read_sockfunc.keys()),
+                                                           list(write_sockfunc.keys()),
+                                                           list(error_sockfunc.keys()),
+                                                           max(0, download.next_deadline() - time()))
+            for sock in read_rdyset:
+                if read_sockfunc[sock](sock):
+                    running = False
+            if running and download.next_deadline() <= time():
+                running = not download.on_timeout(time())
+    except KeyboardInterrupt:   # Ctrl-C keeps the blocks received so far, like any other abort
+        if not download.done():
+            download.error = 'Error: interrupted'
+
+# Method to bring an existing local copy up to date, fetching the server's signature of the file
+# and then only the chunks whose digest differs, written in place; returns the last Download.
+# Every transfer gets its own socket, so the server's retransmissions of one never reach the next
+def sync(server_addr, filename, path, args, stats):
+    sig = BytesIO()
+    download = Download(socket(AF_INET, SOCK_DGRAM), server_addr, filename, sig, args.window, args.timeout, args.maxtries,
+                        stats, options={'sig': 1})
+    run(download, args.engine)
+    download.sock.close()
+    if download.error is not None:
+        return download
+    size, chunk_blocks, digests = parse_signature(sig.getvalue())
+    ranges = changed_ranges(path, chunk_blocks, digests)
+    print('Signature of %d chunks received, %d of them differ' % (len(digests), sum(b - a + 1 for a, b in ranges)))
+    options = {'c': chunk_blocks}
+    ranges = fit_ranges(filename, ranges, options)
+    with open(path, 'r+b') as f:
+        if ranges:
+            download = Download(socket(AF_INET, SOCK_DGRAM), server_addr, filename, RangeWriter(f, byte_ranges(ranges, chunk_blocks, size)),
+                                args.window, args.timeout, args.maxtries, stats,
+                                options=dict(options, r=encode_ranges(ranges)))
+            run(download, args.engine)
+            download.sock.close()
+        if download.error is None:
+            f.truncate(size)
+    if download.error is None:
+        stats.expanded(size)
+        if signature(path, chunk_blocks) != sig.getvalue():     # the file changed on the server in between
+            download.error = 'Error: file changed during the sync, run it again'
+    return download
+
+# Method to get one stripe, the chunks first..last of the file, into its place in the preallocated
+# output, in a process of its own; returns the error or None, and the stripe's statistics
+def get_stripe(server_addr, filename, path, size, chunk_blocks, first, last, args):
+    stats = TransferStats()
+    with open(path, 'r+b') as f:
+        download = Download(socket(AF_INET, SOCK_DGRAM), server_addr, filename,
+                            RangeWriter(f, byte_ranges([(first, last)], chunk_blocks, size)),
+                            args.window, args.timeout, args.maxtries, stats,
+                            options={'c': chunk_blocks, 'r': encode_ranges([(first, last)])})
+        run(download, args.engine)
+        download.sock.close()
+    return download.error, stats
+
+# Method to get a file as args.stripes chunk ranges at once, each by its own process and socket, so that
+# servers with several --workers serve them on as many cores; the file's signature gives its size to
+# preallocate and the digests to check the result against.  Returns the Download of the signature,
+# with the error of the stripes when one failed
+def striped(server_addr, filename, path, args, stats):
+    sig, sig_stats = BytesIO(), TransferStats()    # the signature's own phases would end in a 'done' of their own
+    stats.mark(time(), 'signature')
+    download = Download(socket(AF_INET, SOCK_DGRAM), server_addr, filename, sig, args.window, args.timeout, args.maxtries,
+                        sig_stats, options={'sig': 1})
+    run(download, args.engine)
+    download.sock.close()
+    stats.absorb(sig_stats)
+    if download.error is not None:
+        return download
+    size, chunk_blocks, digests = parse_signature(sig.getvalue())
+    if not digests:     # an empty file has no chunks to share out
+        open(path, 'wb').close()
+        stats.mark(time(), 'done')
+        return download
+    per = -(-len(digests) // args.stripes)      # chunks per stripe
+    stripes = [(first, min(first + per, len(digests)) - 1) for first in range(0, len(digests), per)]
+    for first, last in stripes:     # before the output is created
+        check_request(encode_request(filename, c=chunk_blocks, r=encode_ranges([(first, last)])))
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        if size and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, size)
+    print('Getting %d bytes as %d stripes of up to %d chunks' % (size, len(stripes), per))
+    stats.mark(time(), 'stripes')
+    with Pool(len(stripes)) as pool:
+        results = pool.starmap(get_stripe, [(server_addr, filename, path, size, chunk_blocks, first, last, args) for first, last in stripes])
+    errors = [error for error, _ in results if error is not None]
+    for _, stripe_stats in results:
+        stats.absorb(stripe_stats)
+    if not errors and signature(path, chunk_blocks) != sig.getvalue():     # the file changed on the server in between
+        errors.append('Error: file changed during the striped get, run it again')
+    if errors:
+        os.remove(path)     # the stripes that arrived are not worth a .part of their own
+        download.error = errors[0]
+    else:
+        stats.mark(time(), 'done')
+    return download
+
+# Method to get many files in as few transfers as their names fit into the REQUESTs of, and store them
+# in directory; returns the last Download
+def batch(server_addr, names, directory, args, stats):
+    options = {'b': 1}
+    if args.glob:
+        options['g'] = 1
+    if args.compress:
+        options['z'] = 1
+    writer = BatchWriter(directory)
+    for manifest in pack_manifests(names, options):
+        download = Download(socket(AF_INET, SOCK_DGRAM), server_addr, encode_manifest(manifest), writer,
+                            args.window, args.timeout, args.maxtries, stats, options=options)
+        run(download, args.engine)
+        download.sock.close()
+        if download.error is not None:
+            break
+    writer.close()      # a file cut off by an error is not kept
+    missing = [name for name, size in writer.files if size is None]
+    for name, size in writer.files:
+        print('%s: %s' % (name, 'not found' if size is None else '%d bytes' % size))
+    if missing and download.error is None:
+        download.error = 'Error: %d of %d files were not found' % (len(missing), len(writer.files))
+    return download
+
+
+if __name__ == '__main__':
+    # Create parser for user input
+    parser = argparse.ArgumentParser(description="Retrieve the file with a sliding window and store it on the local machine")
+    parser.add_argument('filename', type=str, nargs='+', help='name of the file to be retrieved, or of several to get them in one batch')
+    parser.add_argument('--glob', action='store_true', help='treat the names as glob patterns the server expands in its directory')
+    parser.add_argument('--server', required=False, default='localhost:50000', help='server address from which, the file will be retrieved')
+    parser.add_argument('--window', type=int, required=False, default=10, help='number of out-of-order blocks that may be buffered')
+    parser.add_argument('--timeout', type=float, required=False, default=1.0, help='initial number of seconds before re-sending a request to the server, adapted to the measured RTT')
+    parser.add_argument('--maxtries', type=int, required=False, default=5, help='number of tries of re-sending a request to the server before giving up')
+    parser.add_argument('--compress', action='store_true', help='ask the server for a zlib compressed stream of the file')
+    parser.add_argument('--sync', action='store_true', help='update an existing local copy by fetching only the chunks that differ from the server\'s file')
+    parser.add_argument('--stripes', type=int, required=False, default=1, help='get the file as this many chunk ranges at once, each from its own process and socket')
+    parser.add_argument('--engine', choices=('select', 'asyncio'), default='select', help='event loop driving the download: select, or asyncio [uvloop when installed]')
+    parser.add_argument('--stats', required=False, default=None, help='write the transfer statistics to this JSON file, or its time series to a .csv file')
+
+    args = parser.parse_args()
+    print(args)
+    if args.stripes < 1:
+        parser.error('--stripes must be at least 1')
+    if args.stripes > 1 and (len(args.filename) > 1 or args.glob or args.sync or args.compress):
+        parser.error('--stripes gets a single file, without --glob, --sync or --compress')
+
+    # Parse the given server address [optional]
+    addr_list = str(args.server).split(':')
+    if len(addr_list) != 2 or len(addr_list[0]) == 0 or len(addr_list[1]) == 0:
+        print('Error: enter a valid server address i.e., IP:port')
+        exit(1)
+
+    output = join(dirname(abspath(__file__)), args.filename[0])
+    server_addr = (addr_list[0], int(addr_list[1]))
+    stats = TransferStats(record_series=args.stats is not None)
+    checkpoint = Checkpoint(output)
+    try:
+        if len(args.filename) > 1 or args.glob:
+            download = batch(server_addr, args.filename, dirname(abspath(__file__)), args, stats)
+        elif args.sync and exists(output) and not exists(checkpoint.path):
+            download = sync(server_addr, args.filename[0], output, args, stats)
+        elif args.stripes > 1:
+            download = striped(server_addr, args.filename[0], output, args, stats)
+            if download.error is None:
+                checkpoint.clear()      # the whole file replaced whatever an earlier attempt left
+        else:
+            options = {'z': 1} if args.compress else {}
+            check_request(encode_request(args.filename[0], **options))     # before the output is created
+            # resume after the blocks an interrupted attempt left in the output file
+            f = checkpoint.open()
+            if checkpoint.held:
+                print('Resuming after block %d (%d bytes already received)' % (checkpoint.held, f.tell()))
+            # a compressed stream is expanded in order, any other download is written block by block where it belongs
+            writer = f if args.compress else BlockWriter(f, checkpoint.held + 1)
+            download = Download(socket(AF_INET, SOCK_DGRAM), server_addr, args.filename[0], writer, args.window, args.timeout, args.maxtries,
+                                stats, checkpoint, options)
+            run(download, args.engine)
+            if download.positional:
+                writer.finish()
+            if download.done():
+                f.close()
+                checkpoint.clear()
+            else:       # keep what arrived for the next attempt
+                checkpoint.save(download.held_on_disk(), writer)
+                f.close()
+    except ValueError as e:     # a name with its options too long for a REQUEST, or a malformed answer
+        print('Error: %s' % e)
+        exit(1)
+    if download.error is not None:
+        stats.mark(time(), 'aborted')
+    print(stats.report())
+    if args.stats is not None:
+        stats.write(args.stats)
+    if download.error is not None:
+        print(download.error)
+        exit(1)
@@ -0,0 +1,352 @@
+import argparse
+from multiprocessing import Process
+from os.path import abspath, dirname, join, splitext
+from select import select
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET
+try:
+    from socket import SO_REUSEPORT
+except ImportError:     # not on every platform, and only --workers needs it
+    SO_REUSEPORT = None
+from sys import path
+from time import time
+
+path.insert(0, join(dirname(abspath(__file__)), '..', '..'))
+from common.aio import serve
+from common.blocks import StreamBlockSource, open_source
+from common.cache import FileCache
+from common.fec import ParityEncoder, fec_group
+from common.pacing import Pacer
+from common.protocol import ACK_RECOVERED, HEADER, MAX_MSG, MsgType, encode_msg, decode_msg, decode_bitmap, decode_request, decode_sack, msg_flags
+from common.rtt import RttEstimator
+from common.stats import TransferStats
+from common.timers import TimerWheel
+
+# Class that holds the state of one file transfer to one client
+class Session:
+    def __init__(self, sock, addr, source, window, timeout, max_tries, stats, start=1, pacer=None, fec=None, expires=None):
+        self.sock, self.addr, self.source, self.stats = sock, addr, source, stats
+        self.window, self.max_tries, self.pacer, self.fec = window, max_tries, pacer, fec
+        self.rtt = RttEstimator(timeout)
+        self.last_block = None  # known once the source has cut it, a compressed stream has no block count up front
+        self.start = start
+        self.base = start       # oldest block not yet acknowledged
+        self.next_block = start # next block that has never been sent
+        self.acked = set()      # acknowledged blocks at or above base
+        self.sent_at = {}       # block -> time of its last transmission
+        self.timers = TimerWheel()  # block -> retransmission timer of every block in flight
+        self.retransmitted = set()  # Karn's rule: blocks sent more than once are not timed
+        self.tries = 0          # timeouts in a row without any acknowledgement
+        self.expires = expires  # time the session is aborted at however it progresses, None for no limit
+
+    # Method to send a block sliced from the mapped file, so a retransmission needs no copy of it
+    def send_block(self, block, now, retransmit=False):
+        is_last_block = self.source.is_last(block)
+        if is_last_block:
+            self.last_block = block
+        payload = self.source.block(block)
+        msg = encode_msg(is_last_block, MsgType.DATA, block, payload)
+        self.sock.sendto(msg, self.addr)
+        self.sent_at[block] = now
+        self.timers.arm(block, now + self.rtt.base_rto)    # without the backoff, which an ACK may reset in the meantime
+        self.stats.sent(now, block, len(msg), retransmit)
+        if self.pacer:
+            self.pacer.on_send(now, len(msg), not retransmit)
+        if self.fec and not retransmit:
+            self.send_parity(block, payload, is_last_block, now)
+
+    # Method to add a block sent for the first time to its parity group, sending the PARITY of a complete group
+    def send_parity(self, block, payload, is_last_block, now):
+        if self.fec.first is None:      # a new group, sized for the loss rate seen so far
+            self.fec.adapt(self.stats.fec_recovered + self.stats.rtx_recovered, self.base - self.start)
+        parity = self.fec.add(block, payload, is_last_block)
+        if parity is None:
+            return
+        first, k_exp, payload = parity
+        msg = encode_msg(False, MsgType.PARITY, first, payload, k_exp)
+        self.sock.sendto(msg, self.addr)
+        self.stats.sent(now, first, len(msg))
+        self.stats.parity(now, first)
+        if self.pacer:
+            self.pacer.on_send(now, len(msg), False)
+
+    # Method to check whether the window has room for a block never sent
+    def can_send(self):
+        return self.next_block < self.base + self.window and (self.last_block is None or self.next_block <= self.last_block)
+
+    # Method to send every block that fits into the window, as far as the pacer lets them go
+    def fill_window(self, now):
+        if self.pacer and not self.sent_at:
+            self.pacer.restart()
+        while self.can_send() and (self.pacer is None or self.pacer.ready(now, MAX_MSG)):
+            self.send_block(self.next_block, now)
+            self.next_block += 1
+
+    # Method to handle an ACK, of a block the client rebuilt from a parity when recovered, with the
+    # client's SACK (cumulative ACK, blocks held beyond it) when it sent one,
+    # returns True once the whole file was acknowledged
+    def handle_ack(self, block, now, nbytes, recovered=False, sack=None):
+        is_new = block in self.sent_at     # sent and not acknowledged yet
+        self.stats.received(now, block, nbytes, duplicate=not is_new)
+        if is_new:
+            self.acknowledge(block, now, recovered, timed=not recovered and block not in self.retransmitted)
+        if sack is not None:    # blocks whose own ACK was lost
+            cumulative, held = sack
+            held = set(held)
+            for b in [b for b in self.sent_at if b <= cumulative or b in held]:
+                self.stats.sack(now, b)
+                self.acknowledge(b, now)
+        if self.base in self.acked:
+            while self.base in self.acked:      # slide the window over the acknowledged prefix
+                self.acked.remove(self.base)
+                self.base += 1
+            self.source.release(self.base)
+            self.fill_window(now)
+        return self.last_block is not None and self.base > self.last_block
+
+    # Method to mark a block in flight acknowledged, timing it when its own ACK answers its only transmission
+    def acknowledge(self, block, now, recovered=False, timed=False):
+        self.acked.add(block)
+        sent = self.sent_at.pop(block)
+        self.timers.cancel(block)
+        if timed:
+            self.rtt.sample(now - sent)
+            self.stats.rtt(now, block, now - sent)
+        elif recovered or block in self.retransmitted:  # lost, and the ACK time includes the recovery
+            self.stats.recovered(now, block, recovered)
+            self.retransmitted.discard(block)
+        nbytes = len(self.source.block(block))
+        self.stats.delivered(nbytes)
+        if self.pacer:
+            self.pacer.on_ack(now, HEADER.size + nbytes, sent if timed else None)
+        self.tries = 0
+        self.rtt.reset_backoff()    # the client is reachable again, even if Karn's rule allowed no sample
+
+    # Method to resend at once the blocks a NACK reports missing, unless a copy went out within the last
+    # half RTT, which makes a duplicated NACK harmless
+    def handle_nack(self, missing, now, nbytes):
+        self.stats.received(now, missing[0], nbytes)
+        self.stats.nack(now, missing[0])
+        self.tries = 0
+        self.rtt.reset_backoff()
+        for block in missing:
+            if block in self.sent_at and now - self.sent_at[block] >= (self.rtt.srtt or 0.0) / 2:
+                self.retransmitted.add(block)
+                self.stats.fast_retransmit(now, block)
+                self.send_block(block, now, retransmit=True)
+
+    # Method to send the blocks the pacer held back and retransmit every block whose timer expired,
+    # returns False when the client is given up on.  A timer runs with the timeout before backoff as of when
+    # its block was sent, so an expired block the current timeout gives more time is re-armed instead
+    def on_timeout(self, now):
+        if self.pacer:
+            self.fill_window(now)
+        rto = self.rtt.rto
+        expired = []
+        for block in self.timers.expire(now):
+            if self.sent_at[block] + rto <= now + self.timers.tick:     # due to within the wheel's resolution
+                expired.append(block)
+            else:
+                self.timers.arm(block, self.sent_at[block] + rto)
+        if not expired:
+            return True
+        if self.tries == self.max_tries:
+            return False
+        self.tries += 1
+        self.stats.timeout(now)
+        self.rtt.backoff()
+        for block in sorted(expired):
+            self.retransmitted.add(block)
+            self.send_block(block, now, retransmit=True)
+        return True
+
+    def next_deadline(self):
+        deadlines = [self.timers.next_deadline(), self.expires]
+        if self.pacer and self.can_send():
+            deadlines.append(self.pacer.next_time(MAX_MSG))
+        deadlines = [d for d in deadlines if d is not None]
+        return min(deadlines) if deadlines else None
+
+    def close(self):
+        self.source.close()
+
+
+# Class that owns the session table of every client currently being served
+class Server:
+    def __init__(self, sock, root, window, timeout, max_tries, stats_path=None, pace=False, rate=None, fec=None, cache=None,
+                 lifetime=None):
+        self.sock, self.root, self.stats_path, self.cache = sock, root, stats_path, cache
+        self.lifetime = lifetime    # seconds a session may last, None for no limit
+        self.window, self.timeout, self.max_tries = window, timeout, max_tries
+        self.pace, self.rate = pace or rate is not None, rate     # pacing at the estimated rate unless one is given
+        self.fec = fec          # K of the parity groups, 'auto' to adapt it to the loss rate, None for no parity
+        self.sessions = {}      # client address -> Session
+        self.timers = TimerWheel()  # client address -> timer at the next deadline of its session
+
+    # Method to open a new session for a REQUEST, or answer with an ERROR [the client already holds blocks 1..held]
+    def open_session(self, addr, payload, now, held=0):
+        try:
+            filename, options = decode_request(payload)
+            source = open_source(self.root, filename, held, options, self.cache)
+        except OSError:     # missing, a directory, below a file or unreadable
+            self.sock.sendto(encode_msg(True, MsgType.ERROR, 0, b'Error: specified file was not found'), addr)
+            return
+        except ValueError as e:
+            self.sock.sendto(encode_msg(True, MsgType.ERROR, 0, ('Error: %s' % e).encode()), addr)
+            return
+        stats = TransferStats(record_series=self.stats_path is not None)
+        stats.mark(now, 'transfer')
+        session = Session(self.sock, addr, source, self.window, self.timeout, self.max_tries, stats, held + 1,
+                          Pacer(self.rate) if self.pace else None, self.parity_encoder(),
+                          now + self.lifetime if self.lifetime is not None else None)
+        self.sessions[addr] = session
+        session.fill_window(now)
+
+    def parity_encoder(self):
+        if self.fec is None:
+            return None
+        return ParityEncoder(adaptive=True) if self.fec == 'auto' else ParityEncoder(self.fec)
+
+    # Method to end a session and report its statistics, written next to --stats with the client address appended
+    def close_session(self, addr, now, outcome):
+        session = self.sessions.pop(addr)
+        self.timers.cancel(addr)
+        session.close()
+        if isinstance(session.source, StreamBlockSource) and session.source.compressed:
+            session.stats.expanded(session.source.file_bytes)
+        session.stats.mark(now, outcome)
+        print("Session %s %s\n%s" % (repr(addr), outcome, session.stats.report()))
+        if self.cache is not None:
+            print(self.cache.report())
+        if self.stats_path is not None:
+            root, ext = splitext(self.stats_path)
+            session.stats.write("%s-%s-%d%s" % (root, addr[0], addr[1], ext))
+
+    # Method to dispatch a received message to the session of its client
+    def handle(self, msg, addr, now):
+        try:
+            _, msgtype, block, payload = decode_msg(msg)
+        except ValueError:      # a malformed datagram is dropped, the other sessions go on
+            return
+        session = self.sessions.get(addr)
+        if msgtype == MsgType.REQUEST:
+            if session is None:     # duplicate REQUESTs are covered by the retransmission timers
+                self.open_session(addr, payload, now, block)
+        elif msgtype == MsgType.ACK and session is not None:
+            if session.handle_ack(block, now, len(msg), msg_flags(msg) == ACK_RECOVERED, decode_sack(payload)):
+                self.close_session(addr, now, 'done')
+        elif msgtype == MsgType.NACK and session is not None:
+            session.handle_nack([block] + decode_bitmap(block, payload), now, len(msg))
+        elif msgtype == MsgType.ERROR:
+            print(bytes(payload).decode(errors='replace'))
+            if session is not None:
+                self.close_session(addr, now, 'aborted')
+        self.rearm(addr)
+
+    # Method to move the timer of the session of addr to the session's next deadline
+    def rearm(self, addr):
+        session = self.sessions.get(addr)
+        deadline = session.next_deadline() if session is not None else None
+        if deadline is None:
+            self.timers.cancel(addr)
+        else:
+            self.timers.arm(addr, deadline)
+
+    def next_deadline(self):
+        return self.timers.next_deadline()
+
+    # Method to run the expired timers of the sessions, in one batch
+    def on_timeout(self, now):
+        for addr in self.timers.expire(now):
+            if addr in self.sessions:
+                self.expire(addr, now)
+                self.rearm(addr)
+
+    # Method to run the expired timer of the session of one client, aborting it once it outlived its lifetime
+    # or the client stopped acknowledging
+    def expire(self, addr, now):
+        session = self.sessions[addr]
+        if session.expires is not None and now >= session.expires - self.timers.tick:
+            self.abort_session(addr, now, 'session lifetime of %g seconds exceeded' % self.lifetime)
+        elif not session.on_timeout(now):
+            self.abort_session(addr, now, 'maximum number of tries was reached')
+
+    # Method to give up on a client, telling it why with an ERROR it may or may not receive
+    def abort_session(self, addr, now, reason):
+        print("Error: %s for client %s, giving up" % (reason, repr(addr)))
+        self.sock.sendto(encode_msg(True, MsgType.ERROR, 0, ('Error: %s' % reason).encode()), addr)
+        self.close_session(addr, now, 'aborted')
+
+
+# Method to serve on the port until interrupted, sharing it through SO_REUSEPORT when there are several
+# workers, among which the kernel spreads the clients by their address
+def run_worker(args):
+    server_socket = socket(AF_INET, SOCK_DGRAM)
+    if args.workers > 1:
+        server_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    server_socket.bind(("", int(args.port)))
+    server = Server(server_socket, dirname(abspath(__file__)), args.window, args.timeout, args.maxtries, args.stats,
+                    args.pace, args.rate, args.fec, FileCache(int(args.cache * 2 ** 20)) if args.cache > 0 else None,
+                    args.lifetime)
+    if args.engine == 'asyncio':
+        serve(server, server_socket)
+    else:
+        # map socket to function to call when socket is....
+        read_sockfunc = {}  # ready for reading
+        write_sockfunc = {}  # ready for writing
+        error_sockfunc = {}  # broken
+
+        read_sockfunc[server_socket] = lambda sock: server.handle(*sock.recvfrom(100), time())
+
+        while True:
+            deadline = server.next_deadline()
+            timeout = max(0, deadline - time()) if deadline is not None else None
+            read_rdyset, write_rdyset, err_rdyset = select(list(read_sockfunc.keys()),
+                                                           list(write_sockfunc.keys()),
+                                                           list(error_sockfunc.keys()),
+                                                           timeout)
+            for sock in read_rdyset:
+                read_sockfunc[sock](sock)
+            server.on_timeout(time())
+
+
+if __name__ == '__main__':
+    # Create parser for user input
+    parser = argparse.ArgumentParser(description="Sliding window server that transfers requested files to clients")
+    parser.add_argument('--port', required=False, default='50001',
+                        help='server port')
+    parser.add_argument('--window', type=int, required=False, default=10,
+                        help='number of blocks that may be in flight at once')
+    parser.add_argument('--timeout', type=float, required=False, default=1.0,
+                        help='initial number of seconds before re-sending an unacknowledged block, adapted to the measured RTT')
+    parser.add_argument('--maxtries', type=int, required=False, default=5,
+                        help='number of timeouts in a row without an acknowledgement before giving up on the client')
+    parser.add_argument('--lifetime', type=float, required=False, default=None,
+                        help='number of seconds a session may last before it is aborted, however it progresses [no limit by default]')
+    parser.add_argument('--pace', action='store_true',
+                        help='space blocks out at the bottleneck rate, estimated from the ACKs of blocks sent in pairs')
+    parser.add_argument('--rate', type=float, required=False, default=None,
+                        help='pace every session at this many bytes/second instead of the estimate [implies --pace]')
+    parser.add_argument('--fec', type=fec_group, required=False, default=None,
+                        help='send a parity block after every group of K blocks [a power of 2 up to 128], or auto to adapt K to the loss rate')
+    parser.add_argument('--cache', type=float, required=False, default=64,
+                        help='megabytes of served files kept in memory for the next clients, least recently used dropped first [0 for none]')
+    parser.add_argument('--workers', type=int, required=False, default=1,
+                        help='processes serving the port together through SO_REUSEPORT, each client address staying with one of them')
+    parser.add_argument('--engine', choices=('select', 'asyncio'), default='select',
+                        help='event loop driving the sessions: select, or asyncio with a timer per session [uvloop when installed]')
+    parser.add_argument('--stats', required=False, default=None,
+                        help='write each session\'s statistics to this JSON file, or its time series to a .csv file, with the client address appended to the name')
+
+    args = parser.parse_args()
+    print(args)
+
+    if args.workers > 1:
+        if SO_REUSEPORT is None:
+            parser.error('--workers needs SO_REUSEPORT, which this platform lacks')
+        workers = [Process(target=run_worker, args=(args,)) for _ in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        run_worker(args)
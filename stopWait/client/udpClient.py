@@ -3,15 +3,24 @@ from enum import Enum
 from os.path import abspath, dirname, join, isfile
 from select import select
 from socket import socket, AF_INET, SOCK_DGRAM
-from struct import pack, unpack
-from sys import argv, exit
+from sys import argv, exit, path
+from time import time
+import zlib
+
+path.insert(0, join(dirname(abspath(__file__)), '..', '..'))
+from common.checkpoint import Checkpoint
+from common.protocol import BLOCK_SIZE, DATA_RETRANSMITTED, MsgType, check_request, encode_msg, decode_msg, encode_request, msg_flags
+from common.rtt import RttEstimator
+from common.stats import TransferStats
 
 # Create parser for user input
 parser = argparse.ArgumentParser(description="Retrieve the file and store it on the local machine")
 parser.add_argument('filename', type=str, help='name of the file to be retrieved')
 parser.add_argument('--server', required=False, default='localhost:50000', help='server address from which, the file will be retrieved')
-parser.add_argument('--timeout', type=int, required=False, default=2, help='number of seconds before re-sending a request to the server')
+parser.add_argument('--timeout', type=float, required=False, default=1.0, help='initial number of seconds before re-sending a request to the server, adapted to the measured RTT')
 parser.add_argument('--maxtries', type=int, required=False, default=5, help='number of tries of re-sending a request to the server before giving up')
+parser.add_argument('--compress', action='store_true', help='ask the server for a zlib compressed stream of the file')
+parser.add_argument('--stats', required=False, default=None, help='write the transfer statistics to this JSON file, or its time series to a .csv file')
 
 if len(argv) <= 1:
     print('Error: file name was not specified')
@@ -27,12 +36,22 @@ if len(addr_list) != 2 or len(addr_list[0]) == 0 or len(addr_list[1]) == 0:
     print('Error: enter a valid server address i.e., IP:port')
     exit(1)
 
-# open a file to write the retrieved file by the server
+# the name and options must fit into one REQUEST
+try:
+    fname = check_request(encode_request(args.filename, **({'z': 1} if args.compress else {})))
+except ValueError as e:
+    print('Error: %s' % e)
+    exit(1)
+
+# open a file to write the retrieved file by the server, resuming after the blocks an interrupted attempt left in it
+checkpoint = Checkpoint(join(dirname(abspath(__file__)), str(args.filename)))
 try:
-    f = open(join(dirname(abspath(__file__)), str(args.filename)), 'w')
+    f = checkpoint.open()
 except FileNotFoundError:
     print('Error: specified file was not found') 
     exit(1)
+if checkpoint.held:
+    print('Resuming after block %d (%d bytes already received)' % (checkpoint.held, f.tell()))
 
 # Enum class used to specify each state the client can be in
 class State(Enum):
@@ -40,54 +59,23 @@ class State(Enum):
     WAITING = 1 
     EXITING = 2
 
-# Enum class used to specify the type of a message
-class MsgType(Enum):
-    DATA = 0
-    REQUEST = 1
-    ACK = 2
-    ERROR = 3   
-
 # Global variables used througout the system
 client_socket = socket(AF_INET, SOCK_DGRAM)
-fname = args.filename
-last_ack_block = 0
+inflater = zlib.decompressobj() if args.compress else None     # expands the blocks of a compressed transfer
+last_ack_block = checkpoint.held    # a REQUEST carries it, so the server starts with the next block
 max_tries = args.maxtries
 server_addr = (addr_list[0], int(addr_list[1]))
 state = State.READY
 timeout = args.timeout
 tries = 0
-
-# Method to encode a message before sending it [encoding based on the defined protocol]
-def encode_msg(is_last_block, msgtype, ack_block, payload):
-    is_last_block_id = 0x10 if is_last_block else 0
-    metadata = is_last_block_id + msgtype.value
-    struct_fmt = "{}s".format(len(payload))
-    payload = payload.encode()
-    
-    msg = pack('B', metadata)       # numbers are packed into hexadecimal strings to send them and easily manage them
-    msg += pack('I', ack_block)
-    msg += pack(struct_fmt, payload)
-
-    return msg
-
-# Method to decode a received message [encoding based on the defined protocol]
-def decode_msg(msg):
-    metadata = unpack('B', msg[:1])[0]
-    ack_block = unpack('I', msg[1:5])[0]
-    payload = msg[5:].decode()
-
-    msgtype_mask = 0x0F         # first byte of metadata is divided into [msgtype | ackblock]
-    lastblock_mask = 0x10
-
-    is_last_block = metadata & lastblock_mask == 0x10
-    msgtype = MsgType(metadata & msgtype_mask)
-
-    return is_last_block, msgtype, ack_block, payload
-
+rtt = RttEstimator(timeout)
+sent_at = 0             # time the last REQUEST or ACK was sent
+retransmitted = False   # Karn's rule: no RTT sample when the last message, or the DATA answering it, was sent more than once
+stats = TransferStats(record_series=args.stats is not None)
 
 # Method to request a get operation to the server
 def get(sock, retry=True):
-    global f, fname, state, last_ack_block, server_addr 
+    global f, fname, state, last_ack_block, server_addr, sent_at, retransmitted
 
     client_msgtype = MsgType.REQUEST if state == State.READY else MsgType.ACK
     stop_writing = False
@@ -95,20 +83,39 @@ def get(sock, retry=True):
     if retry == True:
         msg = encode_msg(False, client_msgtype, last_ack_block, fname)
         sock.sendto(msg, server_addr)
+        sent_at, retransmitted = time(), tries > 0
+        stats.sent(sent_at, last_ack_block, len(msg), retransmitted)
     else:
         msg, server_addr = sock.recvfrom(100)
+        now = time()
         is_last_block, msgtype, ack_block, payload = decode_msg(msg)
         if msgtype == MsgType.DATA:
+            stats.received(now, ack_block, len(msg), duplicate=ack_block != last_ack_block + 1)
             if ack_block == last_ack_block + 1:     # checks that the received block is the next in the sequence
+                if state == State.READY:
+                    stats.mark(now, 'transfer')
+                if not retransmitted and not msg_flags(msg) & DATA_RETRANSMITTED:
+                    rtt.sample(now - sent_at)
+                    stats.rtt(now, ack_block, now - sent_at)
+                stats.delivered(len(payload))
+                if inflater:
+                    payload = inflater.decompress(payload) + (inflater.flush() if is_last_block else b'')
+                    stats.expanded(len(payload))
                 f.write(payload)
                 last_ack_block += 1
+                checkpoint.update(f.tell() // BLOCK_SIZE, f)    # whole blocks of the file on disk
                 state = State.WAITING
                 stop_writing = is_last_block
                 
                 msg = encode_msg(False, MsgType.ACK, last_ack_block, fname)
-                sock.sendto(msg, server_addr)  
+                sock.sendto(msg, server_addr)
+                sent_at, retransmitted = time(), False
+                stats.sent(sent_at, last_ack_block, len(msg))
+                if stop_writing:
+                    stats.mark(sent_at, 'done')
         elif msgtype == MsgType.ERROR:
-            print(payload)
+            print(payload.decode())
+            checkpoint.save(f.tell() // BLOCK_SIZE, f)
             exit(1)
 
     return stop_writing
@@ -121,26 +128,46 @@ error_sockfunc = {}     # broken
 read_sockfunc[client_socket] = get
 
 # Send first request before sleeping for 'timeout' seconds
+stats.mark(time(), 'request')
 get(client_socket)
 tries += 1
 
 running = True
-while running:
-    read_rdyset, write_rdyset, err_rdyset = select(list(read_sockfunc.keys()),
-                                                   list(write_sockfunc.keys()), 
-                                                   list(error_sockfunc.keys()),
-                                                   timeout)
-    if not read_rdyset and not write_rdyset and not err_rdyset:
-        keep_trying = True
-        if tries == max_tries: 
-            print("Error: maximum number of tries was reached, would you like to keep trying? [t | f]")
-            running = input('prompt') == "t"
-        elif running: 
-            tries += 1
-            get(client_socket)
-    else:
-        tries = 0
-        for sock in read_rdyset:
-            if read_sockfunc[sock](sock, False):
-                running = False
-                break
+completed = False
+try:
+    while running:
+        # sleep until the last message's retransmission timeout expires
+        read_rdyset, write_rdyset, err_rdyset = select(list(read_sockfunc.keys()),
+                                                       list(write_sockfunc.keys()), 
+                                                       list(error_sockfunc.keys()),
+                                                       max(0, sent_at + rtt.rto - time()))
+        if not read_rdyset and not write_rdyset and not err_rdyset:
+            keep_trying = True
+            if tries == max_tries: 
+                print("Error: maximum number of tries was reached, would you like to keep trying? [t | f]")
+                running = input('prompt') == "t"
+            elif running: 
+                tries += 1
+                stats.timeout(time())
+                rtt.backoff()
+                get(client_socket)
+        else:
+            tries = 0
+            for sock in read_rdyset:
+                if read_sockfunc[sock](sock, False):
+                    running = False
+                    completed = True
+                    break
+except KeyboardInterrupt:   # Ctrl-C keeps the blocks received so far, like any other abort
+    print('Error: interrupted')
+
+if completed:
+    f.close()
+    checkpoint.clear()
+else:       # keep what arrived for the next attempt
+    checkpoint.save(f.tell() // BLOCK_SIZE, f)
+    f.close()
+    stats.mark(time(), 'aborted')
+print(stats.report())
+if args.stats is not None:
+    stats.write(args.stats)
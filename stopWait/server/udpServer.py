@@ -1,25 +1,35 @@
 import argparse
 from enum import Enum
-from os.path import abspath, dirname, join, isfile
+from os.path import abspath, dirname, join, isfile, splitext
 from select import select
 from socket import socket, AF_INET, SOCK_DGRAM
-from struct import pack, unpack
-from sys import argv, exit
+from sys import argv, exit, path
+from time import time
 
-def peek_file(f):
-    pos = f.tell()
-    line = f.read(95)
-    f.seek(pos)
-    return line
+path.insert(0, join(dirname(abspath(__file__)), '..', '..'))
+from common.blocks import StreamBlockSource, open_source
+from common.cache import FileCache
+from common.protocol import DATA_RETRANSMITTED, MsgType, encode_msg, decode_msg, decode_request
+from common.rtt import RttEstimator
+from common.stats import TransferStats
+from common.timers import TimerWheel
 
 # Create parser for user input
 parser = argparse.ArgumentParser(description="Server that transfers a requested file to a client")
 parser.add_argument('--port', required=False, default='50001',
                     help='server port')
-parser.add_argument('--timeout', type=int, required=False, default=2,
-                    help='number of seconds before re-sending a request to the server')
+parser.add_argument('--timeout', type=float, required=False, default=1.0,
+                    help='initial number of seconds before re-sending a block, adapted to the measured RTT')
 parser.add_argument('--maxtries', type=int, required=False, default=5,
                     help='number of tries of re-sending a request to the server before giving up')
+parser.add_argument('--idle', type=float, required=False, default=30.0,
+                    help='number of seconds without hearing from a client before its session is closed')
+parser.add_argument('--lifetime', type=float, required=False, default=None,
+                    help='number of seconds a session may last before it is aborted, however it progresses [no limit by default]')
+parser.add_argument('--cache', type=float, required=False, default=64,
+                    help='megabytes of served files kept in memory for the next clients, least recently used dropped first [0 for none]')
+parser.add_argument('--stats', required=False, default=None,
+                    help='write each session\'s statistics to this JSON file, or its time series to a .csv file, with the client address appended to the name')
 
 # if len(argv) <= 1:
 #     print('Error: file name was not specified')
@@ -35,104 +45,134 @@ class State(Enum):
     WAITING = 1
     EXITING = 2
 
-# Enum class used to specify the type of a message
-class MsgType(Enum):
-    DATA = 0
-    REQUEST = 1
-    ACK = 2
-    ERROR = 3
-
 # Global variables used througout the system
 server_socket = socket(AF_INET, SOCK_DGRAM)
 server_addr = ("",int(args.port))
 server_socket.bind(server_addr)
-last_ack_block = 0
 max_tries = args.maxtries
-state = State.READY
 timeout = args.timeout
-tries = 0
-byte_s_backup = []
-f=0
-
-def reset():
-    global tries, f, last_ack_block, state, byte_s_backup
-    byte_s_backup = []
-    state = State.READY
-    tries, f, last_ack_block = [0]*3
-
-# Method to encode a message before sending it [encoding based on the defined protocol]
-def encode_msg(is_last_block, msgtype, ack_block, payload):
-    is_last_block_id = 0x10 if is_last_block else 0
-    metadata = is_last_block_id + msgtype.value
-
-    struct_fmt = "{}s".format(len(payload))
-    payload = payload.encode()
-
-    msg = pack('B', metadata)  # numbers are packed into hexadecimal strings to send them and easily manage them
-    msg += pack('I', ack_block)
-    msg += pack(struct_fmt, payload)
-
-    return msg
-
-
-# Method to decode a received message [encoding based on the defined protocol]
-def decode_msg(msg):
-    metadata = unpack('B', msg[:1])[0]
-    ack_block = unpack('I', msg[1:5])[0]
-    payload = msg[5:].decode()
-
-    msgtype_mask = 0x0F  # first byte of metadata is divided into [msgtype | ackblock]
-    lastblock_mask = 0x10
-
-    is_last_block = metadata & lastblock_mask == 0x10
-    msgtype = MsgType(metadata & msgtype_mask)
-
-    return is_last_block, msgtype, ack_block, str(payload)
-
-# Method to request a get operation to the server
-def sendFile(sock, retry=True):
-    global f, state, last_ack_block, client_addr, byte_s_backup
-    stop_sending = False
-
+idle_timeout = args.idle
+lifetime = args.lifetime
+sessions = {}           # client address -> Session
+timers = TimerWheel()   # client address -> timer at the retransmission or idle deadline of its session, whichever is first
+cache = FileCache(int(args.cache * 2 ** 20)) if args.cache > 0 else None   # file contents shared by every session
+
+# Class that holds the state of the transfer to one client
+class Session:
+    def __init__(self, client_addr):
+        self.client_addr = client_addr
+        self.source = None
+        self.last_ack_block = 0
+        self.state = State.READY
+        self.tries = 0
+        self.rtt = RttEstimator(timeout)
+        self.sent_at = 0            # time the outstanding block was last sent
+        self.retransmitted = False  # Karn's rule: no RTT sample from a block that was sent more than once
+        self.last_heard = time()    # time of the last message from the client, for reaping idle sessions
+        self.expires = self.last_heard + lifetime if lifetime is not None else None   # time the session is aborted at
+        self.stats = TransferStats(record_series=args.stats is not None)
+
+    # Method to (re)send the outstanding block, sliced again from the file so no copy of it is kept
+    def send(self, sock, retransmit):
+        block = self.last_ack_block
+        msg = encode_msg(self.source.is_last(block), MsgType.DATA, block, self.source.block(block),
+                         DATA_RETRANSMITTED if retransmit else 0)
+        sock.sendto(msg, self.client_addr)
+        self.sent_at, self.retransmitted = time(), retransmit
+        self.stats.sent(self.sent_at, block, len(msg), retransmit)
+        self.rearm()
+
+    def deadline(self):
+        return self.sent_at + self.rtt.rto
+
+    # Method to set the session's timer to its next retransmission, idle or lifetime deadline
+    def rearm(self):
+        deadlines = [self.last_heard + idle_timeout]
+        if self.state == State.WAITING:
+            deadlines.append(self.deadline())
+        if self.expires is not None:
+            deadlines.append(self.expires)
+        timers.arm(self.client_addr, min(deadlines))
+
+# Method to close a session and report the statistics of its transfer, written next to --stats with the client address appended
+def end_session(session, outcome=None):
+    if session.source:
+        session.source.close()
+        if isinstance(session.source, StreamBlockSource) and session.source.compressed:
+            session.stats.expanded(session.source.file_bytes)
+    del sessions[session.client_addr]
+    timers.cancel(session.client_addr)
+    if outcome is not None:
+        session.stats.mark(time(), outcome)
+        print("Session %s %s\n%s" % (repr(session.client_addr), outcome, session.stats.report()))
+        if cache is not None:
+            print(cache.report())
+        if args.stats is not None:
+            root, ext = splitext(args.stats)
+            session.stats.write("%s-%s-%d%s" % (root, session.client_addr[0], session.client_addr[1], ext))
+
+# Method to give up on the client of a session, telling it why with an ERROR it may or may not receive
+def abort_session(session, reason):
+    print("Error: %s for client %s, closing its session" % (reason, repr(session.client_addr)))
+    server_socket.sendto(encode_msg(True, MsgType.ERROR, 1, ('Error: %s' % reason).encode()), session.client_addr)
+    end_session(session, 'aborted' if session.source else None)
+
+# Method to send a file to the client of a session, or handle a message from any client
+def sendFile(sock, retry=True, session=None):
     if retry == True:
-        stop_sending, byte_s, byte_s_msgtype = byte_s_backup[last_ack_block]
-        msg = encode_msg(stop_sending, byte_s_msgtype, last_ack_block, byte_s)
-        sock.sendto(msg, client_addr)
-    else:
-        msg, client_addr = sock.recvfrom(100)
+        session.send(sock, True)
+        return
+
+    msg, client_addr = sock.recvfrom(100)
+    try:
         _, msgtype, ack_block, payload = decode_msg(msg)
-        if msgtype == MsgType.REQUEST:
-            state = State.WAITING
-            try:
-                f = open(join(dirname(abspath(__file__)), payload), 'r')
-                byte_s = f.read(95)
-                byte_s_msgtype = MsgType.DATA
-                stop_sending = not peek_file(f)            
-            except FileNotFoundError:
-                byte_s = 'Error: specified file was not found'
-                byte_s_msgtype = MsgType.ERROR
-                stop_sending = True
-            last_ack_block += 1
-            byte_s_backup.append((stop_sending, byte_s, byte_s_msgtype))  # record message for retransmition on duplicate
-            msg = encode_msg(stop_sending, byte_s_msgtype, last_ack_block, byte_s)
-            sock.sendto(msg, client_addr)
-        elif msgtype == MsgType.ACK and state == State.WAITING and ack_block <= last_ack_block:
-            if ack_block == last_ack_block: 
-                last_ack_block += 1
-                ack_block = last_ack_block
-                byte_s = f.read(95)
-                byte_s_msgtype = MsgType.DATA
-                stop_sending = not peek_file(f)
-            else:      # retranmission on duplicate
-                stop_sending, byte_s, byte_s_msgtype = byte_s_backup[ack_block] 
-            msg = encode_msg(stop_sending, byte_s_msgtype, ack_block, byte_s)
-            byte_s_backup.append((stop_sending, byte_s, byte_s_msgtype))  # record message for retransmition on duplicate
-            sock.sendto(msg, client_addr)
-        elif msgtype == MsgType.ERROR:
-            print(payload)
-            stop_sending = True
-
-    return stop_sending
+    except ValueError:      # a malformed datagram is dropped, the other sessions go on
+        return
+    session = sessions.get(client_addr)
+    if session is None:
+        if msgtype != MsgType.REQUEST:    # stray message of a transfer that already ended
+            return
+        session = sessions[client_addr] = Session(client_addr)
+    session.last_heard = time()
+    session.tries = 0
+    session.rearm()
+
+    if msgtype == MsgType.REQUEST and session.state == State.READY:
+        try:
+            filename, options = decode_request(payload)
+            session.source = open_source(dirname(abspath(__file__)), filename, ack_block, options, cache)
+        except OSError:     # missing, a directory, below a file or unreadable
+            # nothing to retransmit, a repeated REQUEST gets a new ERROR
+            sock.sendto(encode_msg(True, MsgType.ERROR, 1, b'Error: specified file was not found'), client_addr)
+            end_session(session)
+            return
+        except ValueError as e:
+            sock.sendto(encode_msg(True, MsgType.ERROR, 1, ('Error: %s' % e).encode()), client_addr)
+            end_session(session)
+            return
+        session.state = State.WAITING
+        session.stats.mark(time(), 'transfer')
+        session.last_ack_block = ack_block + 1     # the client already holds blocks 1..ack_block
+        session.send(sock, False)
+    elif msgtype in (MsgType.REQUEST, MsgType.ACK) and session.state == State.WAITING and ack_block <= session.last_ack_block:
+        now = time()
+        session.stats.received(now, ack_block, len(msg), duplicate=ack_block != session.last_ack_block)
+        if ack_block == session.last_ack_block:
+            if not session.retransmitted:
+                session.rtt.sample(now - session.sent_at)
+                session.stats.rtt(now, ack_block, now - session.sent_at)
+            session.stats.delivered(len(session.source.block(ack_block)))
+            if session.source.is_last(ack_block):    # the last block was acknowledged
+                end_session(session, 'done')
+                return
+            session.last_ack_block += 1
+            session.source.release(session.last_ack_block)
+            session.send(sock, False)
+        else:      # retranmission on duplicate, a REQUEST seen again means block 1 was lost
+            session.send(sock, True)
+    elif msgtype == MsgType.ERROR:
+        print(bytes(payload).decode(errors='replace'))
+        end_session(session, 'aborted' if session.source else None)
 
 
 # map socket to function to call when socket is....
@@ -142,24 +182,34 @@ error_sockfunc = {}  # broken
 
 read_sockfunc[server_socket] = sendFile
 
-running = True
-while running:
+while True:
+    # sleep until the nearest retransmission timeout, idle or lifetime deadline of any session
+    deadline = timers.next_deadline()
+    wait = max(0, deadline - time()) if deadline is not None else None
     read_rdyset, write_rdyset, err_rdyset = select(list(read_sockfunc.keys()),
                                                    list(write_sockfunc.keys()),
                                                    list(error_sockfunc.keys()),
-                                                   timeout)
-    if not read_rdyset and not write_rdyset and not err_rdyset:
-        if state == 1:
-            # print("retry")
-            keep_trying = True
-            if tries == max_tries:
-                print("Error: maximum number of tries was reached, would you like to keep trying? [t | f]")
-                running = input('prompt') == "t"
-            elif running:
-                tries += 1
-                sendFile(server_socket)
-    else:
-        tries = 0
-        for sock in read_rdyset:
-            if read_sockfunc[sock](sock, False):
-                reset()
+                                                   wait)
+    for sock in read_rdyset:
+        read_sockfunc[sock](sock, False)
+
+    # a client that stopped answering is timed out on its own, the others are served on meanwhile
+    now = time()
+    for client_addr in timers.expire(now):     # only the sessions whose timer expired, due to within a tick
+        session = sessions.get(client_addr)
+        if session is None:
+            continue
+        if session.expires is not None and now >= session.expires - timers.tick:
+            abort_session(session, 'session lifetime of %g seconds exceeded' % lifetime)
+        elif now - session.last_heard >= idle_timeout - timers.tick:
+            abort_session(session, 'idle for %g seconds' % idle_timeout)
+        elif session.state == State.WAITING and session.deadline() <= now + timers.tick:
+            if session.tries == max_tries:
+                abort_session(session, 'maximum number of tries was reached')
+            else:
+                session.tries += 1
+                session.stats.timeout(now)
+                session.rtt.backoff()
+                sendFile(server_socket, True, session)
+        if client_addr in sessions and client_addr not in timers:     # nothing was due yet
+            session.rearm()